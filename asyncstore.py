@@ -0,0 +1,95 @@
+'''Calls of ListStore and DocStore that return at once, for
+event-loop services. A call returns a concurrent.futures.Future (the
+futures package on Python 2), which an event loop can wait on, e.g.
+with asyncio.wrap_future, trollius.wrap_future or the add_future of a
+tornado IOLoop.
+
+The stores do blocking I/O with boto and redis-py, so the calls are
+run on a ThreadPoolExecutor, an IOPool, and each holds one of its
+threads while it runs: no more than the threads of the pool are in
+progress at once, and further calls wait in turn. Size the pool, and
+the connection pools of the store, for the calls to be kept in
+flight.'''
+import iopool
+
+### ------------------------------------------
+class AsyncStore:
+    '''Run the calls on :store in the background, at most :threads
+    (CALL_THREADS) at a time; more wait for a thread in turn.'''
+
+    # calls in progress at once, unless given
+    CALL_THREADS = 32
+
+    def __init__(self, store, threads=None):
+        self.store = store
+        self.pool = iopool.IOPool(threads or self.CALL_THREADS)
+
+    def call(self, fn, *args, **kw):
+        '''Run fn(*args, **kw) in the background. Returns a
+        concurrent.futures.Future; a call cancelled before it starts
+        is not run.'''
+        return self.pool.submit(fn, *args, **kw)
+
+
+### ------------------------------------------
+class AsyncListStore(AsyncStore):
+    '''The calls of the ListStore :store, each returning a Future of
+    the result of the ListStore method of the same name.'''
+
+    ### ------------------------------------------
+    def append(self, *args, **kw):
+        return self.call(self.store.append, *args, **kw)
+
+    ### ------------------------------------------
+    def reverseScan(self, *args, **kw):
+        return self.call(self.store.reverseScan, *args, **kw)
+
+    ### ------------------------------------------
+    def retrieve(self, *args, **kw):
+        return self.call(self.store.retrieve, *args, **kw)
+
+    ### ------------------------------------------
+    def setSeen(self, *args, **kw):
+        return self.call(self.store.setSeen, *args, **kw)
+
+    ### ------------------------------------------
+    def setDismissed(self, *args, **kw):
+        return self.call(self.store.setDismissed, *args, **kw)
+
+    ### ------------------------------------------
+    def count(self, *args, **kw):
+        return self.call(self.store.count, *args, **kw)
+
+
+### ------------------------------------------
+class AsyncDocStore(AsyncStore):
+    '''The calls of the DocStore :store, each returning a Future of
+    the result of the DocStore method of the same name.'''
+
+    ### ------------------------------------------
+    def get(self, *args, **kw):
+        return self.call(self.store.get, *args, **kw)
+
+    ### ------------------------------------------
+    def getMany(self, *args, **kw):
+        return self.call(self.store.getMany, *args, **kw)
+
+    ### ------------------------------------------
+    def putMany(self, *args, **kw):
+        return self.call(self.store.putMany, *args, **kw)
+
+    ### ------------------------------------------
+    def put(self, *args, **kw):
+        return self.call(self.store.put, *args, **kw)
+
+    ### ------------------------------------------
+    def list(self, *args, **kw):
+        return self.call(self.store.list, *args, **kw)
+
+    ### ------------------------------------------
+    def listPage(self, *args, **kw):
+        return self.call(self.store.listPage, *args, **kw)
+
+    ### ------------------------------------------
+    def delete(self, *args, **kw):
+        return self.call(self.store.delete, *args, **kw)
@@ -0,0 +1,487 @@
+'''Benchmarks of ListStore and DocStore against local stand-ins for S3
+and Redis.
+
+    python bench.py [--s3-latency MS] [--redis-latency MS] [--s3-dir DIR]
+                    [--redis HOST:PORT] [--lists N] [--workload NAME] ...
+
+S3 is kept in memory, or in files under --s3-dir. Redis is fakeredis,
+or a real server given by --redis. Both stand-ins can add a latency to
+every request, and count the requests: S3 GETs and PUTs, and Redis
+round trips (a pipeline is one). Each workload reports ops/s, p50 and
+p99 latency, and the requests per operation.'''
+import time, sys, os, random, argparse, threading
+import boto, boto.exception, boto.resultset, boto.s3.multidelete, boto.s3.prefix
+import redis
+import liststore, docstore, connpool
+
+### ------------------------------------------
+class S3Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {'get': 0, 'put': 0, 'list': 0, 'delete': 0}
+
+    def count(self, call):
+        with self.lock:
+            self.calls[call] += 1
+
+
+### ------------------------------------------
+class FakeKey:
+    '''The part of boto.s3.key.Key used by the stores.'''
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.key = name
+        self.name = name
+
+    def set_contents_from_string(self, s):
+        self.bucket.request('put')
+        self.bucket.objects.put(self.key, str(s))
+
+    def get_contents_as_string(self):
+        self.bucket.request('get')
+        s = self.bucket.objects.get(self.key)
+        if s is None:
+            raise boto.exception.S3ResponseError(404, 'Not Found')
+        return s
+
+    def close(self):
+        pass
+
+
+### ------------------------------------------
+class MemoryObjects:
+    def __init__(self):
+        self.tab = {}
+        self.lock = threading.Lock()
+
+    def get(self, k):
+        return self.tab.get(k)
+
+    def put(self, k, s):
+        with self.lock:
+            self.tab[k] = s
+
+    def delete(self, k):
+        with self.lock:
+            self.tab.pop(k, None)
+
+    def keys(self):
+        with self.lock:
+            return sorted(self.tab.keys())
+
+
+### ------------------------------------------
+class FileObjects:
+    '''Objects kept as files under the directory :root.'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def __path(self, k):
+        return os.path.join(self.root, k)
+
+    def get(self, k):
+        try:
+            with open(self.__path(k), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, k, s):
+        path = self.__path(k)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        # write and rename, so readers never see a partial object
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(s)
+        os.rename(tmp, path)
+
+    def delete(self, k):
+        try:
+            os.unlink(self.__path(k))
+        except OSError:
+            pass
+
+    def keys(self):
+        out = []
+        for (d, dirs, files) in os.walk(self.root):
+            for f in files:
+                if not f.endswith('.tmp'):
+                    out += [os.path.relpath(os.path.join(d, f), self.root)]
+        return sorted(out)
+
+
+### ------------------------------------------
+class FakeBucket:
+    '''The part of boto.s3.bucket.Bucket used by the stores.'''
+
+    def __init__(self, name, objects, latency, stats):
+        self.name = name
+        self.objects = objects
+        self.latency = latency
+        self.stats = stats
+
+    def request(self, call):
+        self.stats.count(call)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def new_key(self, k):
+        return FakeKey(self, k)
+
+    def list(self, prefix='', delimiter=''):
+        # like boto, page through get_all_keys; keys rolled up by
+        # :delimiter come back as Prefix entries
+        marker = ''
+        while True:
+            rs = self.get_all_keys(prefix=prefix, marker=marker, delimiter=delimiter)
+            for key in rs:
+                yield key
+            if not rs.is_truncated:
+                return
+            marker = rs.next_marker
+
+    def get_all_keys(self, prefix='', marker='', delimiter='', max_keys=1000):
+        self.request('list')
+        out = boto.resultset.ResultSet()
+        for k in self.objects.keys():
+            if not k.startswith(prefix) or k <= marker:
+                continue
+            key = FakeKey(self, k)
+            if delimiter and delimiter in k[len(prefix):]:
+                p = k[:k.index(delimiter, len(prefix)) + len(delimiter)]
+                # the keys are sorted, so those of a prefix are together
+                if p <= marker or (out and out[-1].name == p):
+                    continue
+                key = boto.s3.prefix.Prefix(name=p)
+            if len(out) == max_keys:
+                out.is_truncated = True
+                out.next_marker = out[-1].name
+                break
+            out.append(key)
+        return out
+
+    def delete_key(self, k):
+        self.request('delete')
+        self.objects.delete(getattr(k, 'name', k))
+
+    def delete_keys(self, keys, quiet=False):
+        self.request('delete')
+        for k in keys:
+            self.objects.delete(getattr(k, 'name', k))
+        return boto.s3.multidelete.MultiDeleteResult()
+
+
+### ------------------------------------------
+class FakeS3:
+    '''Stand-in for boto.connect_s3, to give connpool.S3Pool. All
+    connections share the buckets.'''
+
+    def __init__(self, root=None, latency=0):
+        self.root = root
+        self.latency = latency
+        self.stats = S3Stats()
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, *args, **kw):
+        return self
+
+    def get_bucket(self, name):
+        with self.lock:
+            if name not in self.buckets:
+                if self.root:
+                    objects = FileObjects(os.path.join(self.root, name))
+                else:
+                    objects = MemoryObjects()
+                self.buckets[name] = FakeBucket(name, objects, self.latency, self.stats)
+            return self.buckets[name]
+
+
+### ------------------------------------------
+class RedisStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def count(self):
+        with self.lock:
+            self.calls += 1
+
+
+### ------------------------------------------
+def countingConnection(base, stats, latency):
+    '''Return a subclass of the redis connection class :base that
+    counts the round trips, and sleeps :latency seconds in each.'''
+    class Connection(base):
+        def send_packed_command(self, command, *args, **kw):
+            stats.count()
+            if latency:
+                time.sleep(latency)
+            return base.send_packed_command(self, command, *args, **kw)
+    return Connection
+
+
+### ------------------------------------------
+class FakeRedis:
+    '''A Redis connection pool, to one fakeredis server or to the real
+    server :hostport, counting the round trips.'''
+
+    def __init__(self, hostport=None, latency=0):
+        self.stats = RedisStats()
+        if hostport:
+            (host, port) = hostport.split(':')
+            conn = countingConnection(redis.Connection, self.stats, latency)
+            self.pool = redis.ConnectionPool(connection_class=conn, host=host, port=int(port))
+        else:
+            try:
+                import fakeredis
+            except ImportError:
+                sys.exit('fakeredis is not installed; pass --redis HOST:PORT')
+            conn = countingConnection(fakeredis.FakeConnection, self.stats, latency)
+            self.pool = redis.ConnectionPool(connection_class=conn, server=fakeredis.FakeServer())
+        self.client = redis.StrictRedis(connection_pool=self.pool)
+
+
+### ------------------------------------------
+# the Redis keys of the stores benchmarked; on a real server only
+# these are deleted
+BENCH_KEYS = ['liststore::bench::*', 'docstore::bench/*']
+
+def clearRedis(client):
+    '''Delete the keys of the benchmark from the Redis server of
+    :client, with SCAN, and leave the other keys alone.'''
+    keys = [k for match in BENCH_KEYS for k in client.scan_iter(match=match, count=1000)]
+    for i in xrange(0, len(keys), 1000):
+        client.delete(*keys[i:i+1000])
+
+
+### ------------------------------------------
+class Result:
+    '''The timings and request counts of a workload.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.times = []
+        self.s3 = {}
+        self.redis = 0
+        self.seconds = 0
+
+    def percentile(self, p):
+        t = sorted(self.times)
+        return t[min(len(t) - 1, int(len(t) * p / 100.0))]
+
+    def row(self):
+        n = float(len(self.times))
+        return '%-20s %7d %9.1f %8.2f %8.2f %7.2f %7.2f %7.2f' % (
+            self.name, n, n / self.seconds, self.percentile(50) * 1000, self.percentile(99) * 1000,
+            self.s3.get('get', 0) / n, self.s3.get('put', 0) / n, self.redis / n)
+
+HEADER = '%-20s %7s %9s %8s %8s %7s %7s %7s' % (
+    'workload', 'ops', 'ops/s', 'p50 ms', 'p99 ms', 's3 get', 's3 put', 'redis')
+
+
+### ------------------------------------------
+class Bench:
+    def __init__(self, s3, rs, args):
+        self.s3 = s3
+        self.rs = rs
+        self.s3pool = connpool.S3Pool('x', 'y', connect=s3)
+        self.args = args
+        self.random = random.Random(args.seed)
+
+    def run(self, name, ops):
+        '''Run the calls in :ops, an iterable of thunks, timing each,
+        and return a Result.'''
+        r = Result(name)
+        s3before = dict(self.s3.stats.calls)
+        rbefore = self.rs.stats.calls
+        start = time.time()
+        for fn in ops:
+            t = time.time()
+            fn()
+            r.times.append(time.time() - t)
+        r.seconds = time.time() - start
+        r.s3 = dict((k, self.s3.stats.calls[k] - s3before[k]) for k in s3before)
+        r.redis = self.rs.stats.calls - rbefore
+        return r
+
+    def listStore(self):
+        a = self.args
+        kw = {}
+        if a.page_cache:
+            kw['page_cache'] = liststore.PageCache()
+        if a.write_behind is not None:
+            kw['write_behind'] = a.write_behind
+        if a.append_log is not None:
+            kw['append_log'] = a.append_log
+        if a.row_cache:
+            kw['row_cache'] = a.row_cache
+        if a.io_threads:
+            kw['io_threads'] = a.io_threads
+        return liststore.ListStore('bench', 'x', 'y', 'localhost', 6379,
+                                   codec=a.codec, cache_codec=a.cache_codec, **self.pools(kw))
+
+    def pools(self, kw):
+        '''Add the stand-ins of S3 and Redis to the store options :kw.'''
+        kw.update(redis_pool=self.rs.pool, s3_pool=self.s3pool)
+        return kw
+
+    def names(self):
+        return ['bench-u%d' % i for i in xrange(self.args.lists)]
+
+    ### ------------------------------------------
+    def appendBursts(self):
+        '''Append a year of rows to each list, in bursts of 1 to 20,
+        the bursts of all lists interleaved.'''
+        ls = self.listStore()
+        for name in self.names():
+            ls.deleteName(name)
+        start = time.mktime((2013, 1, 1, 0, 0, 0, 0, 0, 0))
+        bursts = {}
+        for name in self.names():
+            (t, out) = (start, [])
+            while t < start + 365 * 86400:
+                rows = []
+                for i in xrange(self.random.randint(1, 20)):
+                    t += self.random.uniform(0.5, 1.5) * 86400 / self.args.rows_per_day
+                    rows += [(t, 'event %s at %f' % (name, t))]
+                out += [rows]
+            bursts[name] = out
+        ops = []
+        while bursts:
+            name = self.random.choice(sorted(bursts.keys()))
+            ops += [lambda name=name, rows=bursts[name].pop(0): ls.append(name, rows)]
+            if not bursts[name]:
+                del bursts[name]
+        r = self.run('append burst', ops)
+        ls.close()
+        return r
+
+    def badgeCount(self):
+        '''count() of random lists, as drawn for an unread badge.'''
+        ls = self.listStore()
+        names = self.names()
+        ops = [lambda name=self.random.choice(names): ls.count(name) for i in xrange(self.args.ops)]
+        return self.run('badge count', ops)
+
+    def deepScan(self):
+        '''reverseScan pages of 50 at growing offsets, from the newest
+        row back.'''
+        ls = self.listStore()
+        names = self.names()
+        ops = []
+        for i in xrange(self.args.ops):
+            name = self.random.choice(names)
+            offset = 50 * self.random.randint(0, 40)
+            ops += [lambda name=name, offset=offset: ls.reverseScan(name, 2e9, limit=50, offset=offset)]
+        return self.run('deep reverseScan', ops)
+
+    def cursorScan(self):
+        '''reverseScanPage through whole lists, 50 rows a page.'''
+        ls = self.listStore()
+        def pages():
+            for name in self.names():
+                state = {'cursor': None, 'more': True}
+                while state['more']:
+                    def page(name=name, state=state):
+                        (rows, state['cursor']) = ls.reverseScanPage(name, 2e9, limit=50,
+                                                                     cursor=state['cursor'])
+                        state['more'] = state['cursor'] is not None
+                    yield page
+        return self.run('cursor pages', pages())
+
+    def seenPrior(self):
+        '''setSeen(prior=True) at random times of the year.'''
+        ls = self.listStore()
+        names = self.names()
+        start = time.mktime((2013, 1, 1, 0, 0, 0, 0, 0, 0))
+        ops = []
+        for i in xrange(self.args.ops):
+            name = self.random.choice(names)
+            t = start + self.random.uniform(0, 365 * 86400)
+            ops += [lambda name=name, t=t: ls.setSeen(name, t, prior=True)]
+        r = self.run('setSeen prior', ops)
+        ls.close()
+        return r
+
+    def docPut(self):
+        '''put() of 2KB documents, over 500 ids.'''
+        ds = docstore.DocStore('bench-docs', 'x', 'y', 'localhost', 6379,
+                               codec=self.args.codec, cache_codec=self.args.cache_codec,
+                               **self.pools({}))
+        body = 'x' * 2000
+        ops = [lambda i=i: ds.put('bench', str(i % 500), body + str(i)) for i in xrange(self.args.ops)]
+        return self.run('doc put', ops)
+
+    def docGet(self):
+        '''get() of random documents.'''
+        ds = docstore.DocStore('bench-docs', 'x', 'y', 'localhost', 6379,
+                               codec=self.args.codec, cache_codec=self.args.cache_codec,
+                               **self.pools({}))
+        # ids past 500 were never put
+        ops = [lambda id=str(self.random.randint(0, 600)): ds.get('bench', id) for i in xrange(self.args.ops)]
+        return self.run('doc get', ops)
+
+    def docGetMany(self):
+        '''getMany() of 50 random documents, as for a page of
+        notifications.'''
+        ds = docstore.DocStore('bench-docs', 'x', 'y', 'localhost', 6379,
+                               codec=self.args.codec, cache_codec=self.args.cache_codec,
+                               **self.pools({}))
+        ops = [lambda ids=[str(self.random.randint(0, 600)) for j in xrange(50)]: ds.getMany('bench', ids)
+               for i in xrange(self.args.ops / 10)]
+        return self.run('doc getMany 50', ops)
+
+    def docList(self):
+        '''listPage() of 50 ids, from one of 10 ids, with listing
+        pages cached in Redis.'''
+        ds = docstore.DocStore('bench-docs', 'x', 'y', 'localhost', 6379,
+                               list_cache=60, **self.pools({}))
+        ops = [lambda i=50 * self.random.randint(0, 9): ds.listPage('bench', 50, 'bench/%d.gz' % i)
+               for i in xrange(self.args.ops)]
+        return self.run('doc listPage 50', ops)
+
+
+WORKLOADS = ['appendBursts', 'badgeCount', 'deepScan', 'cursorScan', 'seenPrior', 'docPut', 'docGet', 'docGetMany', 'docList']
+
+### ------------------------------------------
+def main(argv):
+    p = argparse.ArgumentParser(description='Benchmark ListStore and DocStore locally.')
+    p.add_argument('--s3-latency', type=float, default=0, help='ms added to each S3 request')
+    p.add_argument('--redis-latency', type=float, default=0, help='ms added to each Redis round trip')
+    p.add_argument('--s3-dir', help='keep S3 objects in files under this directory')
+    p.add_argument('--redis', help='use the Redis server HOST:PORT instead of fakeredis')
+    p.add_argument('--lists', type=int, default=20, help='number of lists')
+    p.add_argument('--rows-per-day', type=int, default=5, help='rows per list per day, roughly')
+    p.add_argument('--ops', type=int, default=500, help='operations per read workload')
+    p.add_argument('--workload', action='append', choices=WORKLOADS, help='run only these workloads')
+    p.add_argument('--page-cache', action='store_true')
+    p.add_argument('--write-behind', type=float)
+    p.add_argument('--append-log', type=float)
+    p.add_argument('--row-cache', type=int)
+    p.add_argument('--io-threads', type=int)
+    p.add_argument('--codec', default='gzip')
+    p.add_argument('--cache-codec')
+    p.add_argument('--seed', type=int, default=1)
+    args = p.parse_args(argv)
+
+    s3 = FakeS3(args.s3_dir, args.s3_latency / 1000.0)
+    rs = FakeRedis(args.redis, args.redis_latency / 1000.0)
+    if args.redis:
+        clearRedis(rs.client)
+
+    b = Bench(s3, rs, args)
+    print HEADER
+    for w in args.workload or WORKLOADS:
+        print getattr(b, w)().row()
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+'''The policy deciding what is cached in Redis, and for how long.'''
+import time, threading
+
+### ------------------------------------------
+def monthsBetween(yyyymm, t):
+    '''Return the number of months from month :yyyymm to the month of
+    unix time :t.'''
+    tm = time.gmtime(t)
+    return (tm.tm_year * 12 + tm.tm_mon) - (int(yyyymm[:4]) * 12 + int(yyyymm[4:6]))
+
+
+### ------------------------------------------
+class CachePolicy:
+    '''How objects are cached in Redis.
+
+    An object is kept for :ttl seconds, or for :old_ttl seconds if it
+    is a page of a month more than :hot_months months old. An object
+    read from S3 is admitted to Redis on its :admit_after'th miss
+    within :hits_ttl seconds, if it is at most :max_object bytes, and
+    if the measured Redis usage of its store is below :max_memory
+    bytes. Objects written are always cached, unless larger than
+    :max_object.
+
+    A CachePolicy may be shared by several stores.'''
+
+    def __init__(self, ttl=30 * 24 * 60 * 60, old_ttl=None, hot_months=1, admit_after=1,
+                 hits_ttl=24 * 60 * 60, max_object=None, max_memory=None, usage_ttl=60):
+        self.ttl = ttl
+        self.old_ttl = old_ttl
+        self.hot_months = hot_months
+        self.admit_after = admit_after
+        self.hits_ttl = hits_ttl
+        self.max_object = max_object
+        self.max_memory = max_memory
+        self.usage_ttl = usage_ttl
+        self.usages = {}   # prefix -> (time read, bytes)
+        self.lock = threading.Lock()
+
+    def expiry(self, yyyymm=None):
+        '''Return the TTL of an object; :yyyymm is the month of a
+        page.'''
+        if yyyymm and self.old_ttl is not None and monthsBetween(yyyymm, time.time()) > self.hot_months:
+            return self.old_ttl
+        return self.ttl
+
+    def fits(self, nbytes):
+        '''Tell whether an object of :nbytes may be cached at all.'''
+        return self.max_object is None or nbytes <= self.max_object
+
+    def admit(self, rconn, prefix, items):
+        '''Tell, for each (rk, nbytes) in :items read from S3, whether
+        to cache it under Redis key rk. :prefix is the key prefix of
+        the store.'''
+        if not items:
+            return []
+        out = [self.fits(nbytes) for (rk, nbytes) in items]
+        if self.max_memory is not None and self.usage(rconn, prefix) >= self.max_memory:
+            return [False] * len(items)
+        if self.admit_after > 1:
+            pipe = rconn.pipeline(transaction=False)
+            for (rk, nbytes) in items:
+                pipe.incr(rk + '::hits')
+                pipe.expire(rk + '::hits', self.hits_ttl)
+            hits = pipe.execute()[::2]
+            out = [ok and n >= self.admit_after for (ok, n) in zip(out, hits)]
+        return out
+
+    def usage(self, rconn, prefix):
+        '''Return the Redis bytes of the store with key :prefix, as
+        last measured, or 0 if never measured. The figure is reread
+        from Redis every :usage_ttl seconds.'''
+        with self.lock:
+            e = self.usages.get(prefix)
+        if e and e[0] + self.usage_ttl > time.time():
+            return e[1]
+        n = int(rconn.hget(prefix + 'mem', 'bytes') or 0)
+        with self.lock:
+            self.usages[prefix] = (time.time(), n)
+        return n
+
+    def measure(self, rconn, prefix):
+        '''Measure the Redis usage of the store with key :prefix, by
+        scanning its keys, and record it for admission. Returns
+        {keys, bytes, time}. The bytes are those of the string values
+        and of the key names; other overheads are not counted.'''
+        keys = nbytes = 0
+        batch = []
+        for rk in rconn.scan_iter(match=prefix + '*', count=1000):
+            batch += [rk]
+            if len(batch) == 1000:
+                (k, n) = self.__strlen(rconn, batch)
+                (keys, nbytes, batch) = (keys + k, nbytes + n, [])
+        (k, n) = self.__strlen(rconn, batch)
+        m = {'keys': keys + k, 'bytes': nbytes + n, 'time': time.time()}
+        rconn.hmset(prefix + 'mem', m)
+        with self.lock:
+            self.usages[prefix] = (time.time(), m['bytes'])
+        return m
+
+    @staticmethod
+    def __strlen(rconn, rks):
+        if not rks:
+            return (0, 0)
+        pipe = rconn.pipeline(transaction=False)
+        for rk in rks:
+            pipe.strlen(rk)
+        # non-string keys, like append logs, fail STRLEN
+        lens = [n for n in pipe.execute(raise_on_error=False) if isinstance(n, (int, long))]
+        return (len(rks), sum(lens) + sum(len(rk) for rk in rks))
@@ -0,0 +1,133 @@
+'''Compression codecs for the objects saved in S3 and Redis.
+
+A codec is named by a spec 'name' or 'name:level', e.g. 'zlib:6'.
+Objects written by any codec but gzip start with a 4 byte header:
+the magic 'CZ', the header version and the codec id. gzip objects are
+written without it, as they were before codecs could be chosen, so a
+bucket may hold objects of any mix of codecs.'''
+import StringIO, gzip, zlib, bz2, struct
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+### ------------------------------------------
+class Error(Exception):
+    '''Base class for exceptions in this module.'''
+    pass
+
+### ------------------------------------------
+class DataError(Error):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+HEADER = struct.Struct('<2sBB')
+MAGIC = 'CZ'
+
+### ------------------------------------------
+class Codec:
+    def __init__(self, name, id, compress, uncompress, level):
+        self.name = name
+        self.id = id
+        self.compress = compress
+        self.uncompress = uncompress
+        self.level = level
+
+CODECS = {}
+IDS = {}
+
+### ------------------------------------------
+def register(name, id, compress, uncompress, level=None):
+    '''Register codec :name under the header id :id (0-255).
+    compress(s, level) and uncompress(z) work on the bare payload;
+    :level is the default level.'''
+    c = Codec(name, id, compress, uncompress, level)
+    CODECS[name] = c
+    IDS[id] = c
+
+### ------------------------------------------
+def lookup(spec):
+    '''Return (codec, level) for the codec spec :spec.'''
+    (name, _, level) = spec.partition(':')
+    c = CODECS.get(name)
+    if not c:
+        raise Error('unknown codec %s' % name)
+    if not level:
+        return (c, c.level)
+    try:
+        return (c, int(level))
+    except ValueError:
+        raise Error('bad codec level %s' % spec)
+
+### ------------------------------------------
+def codecOf(z):
+    '''Return the name of the codec that wrote :z.'''
+    if z[:2] == '\x1f\x8b':
+        return 'gzip'
+    if len(z) < HEADER.size or z[:2] != MAGIC:
+        raise DataError('unknown object format')
+    (magic, version, id) = HEADER.unpack_from(z)
+    if version != 1 or id not in IDS:
+        raise DataError('unknown codec id %d version %d' % (id, version))
+    return IDS[id].name
+
+### ------------------------------------------
+def compress(s, spec='gzip'):
+    '''Compress string :s with the codec :spec.'''
+    (c, level) = lookup(spec)
+    z = c.compress(s, level)
+    if c.name == 'gzip':
+        return z
+    return HEADER.pack(MAGIC, 1, c.id) + z
+
+### ------------------------------------------
+def uncompress(z):
+    '''Uncompress :z, written by any registered codec.'''
+    c = CODECS[codecOf(z)]
+    if c.name == 'gzip':
+        return c.uncompress(z)
+    return c.uncompress(z[HEADER.size:])
+
+### ------------------------------------------
+def recode(z, spec, s=None):
+    '''Return :z written by the codec :spec; :z itself if it was
+    written by that codec, at whatever level. :s, if given, is
+    uncompress(z).'''
+    if codecOf(z) == lookup(spec)[0].name:
+        return z
+    if s is None:
+        s = uncompress(z)
+    return compress(s, spec)
+
+
+### ------------------------------------------
+def gzipCompress(s, level):
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level) as f:
+        f.write(s)
+    return buf.getvalue()
+
+### ------------------------------------------
+def gzipUncompress(z):
+    buf = StringIO.StringIO(z)
+    with gzip.GzipFile(fileobj=buf, mode='rb') as f:
+        s = f.read()
+    return s
+
+### ------------------------------------------
+def deflateCompress(s, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(s) + c.flush()
+
+
+register('none', 0, lambda s, level: s, lambda z: z)
+register('gzip', 1, gzipCompress, gzipUncompress, 9)
+register('zlib', 2, lambda s, level: zlib.compress(s, level), zlib.decompress, 6)
+register('deflate', 3, deflateCompress, lambda z: zlib.decompress(z, -zlib.MAX_WBITS), 6)
+register('bz2', 4, lambda s, level: bz2.compress(s, level), bz2.decompress, 9)
+if lzma:
+    register('lzma', 5, lambda s, level: lzma.compress(s, preset=level), lzma.decompress, 6)
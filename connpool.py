@@ -0,0 +1,105 @@
+'''Connection pools of the stores, shared by threads, and by stores
+given the same pool. After a fork, the child process opens its own
+connections rather than use those of its parent.'''
+import os, threading, contextlib
+import boto, boto.exception
+import redis
+
+### ------------------------------------------
+def redisPool(host, port, size=None, timeout=20):
+    '''Return a Redis connection pool to :host and :port. If :size is
+    given, at most :size connections are open, and a thread wanting
+    one more waits for one to be released, for at most :timeout
+    seconds. redis-py pools already reset themselves after a fork.'''
+    if size:
+        return redis.BlockingConnectionPool(host=host, port=int(port), max_connections=size, timeout=timeout)
+    return redis.ConnectionPool(host=host, port=int(port))
+
+
+### ------------------------------------------
+class S3Pool:
+    '''A pool of at most :size S3 connections. A connection keeps its
+    HTTP connections alive while idle in the pool, so that a request
+    seldom pays for a TCP and TLS handshake. A thread wanting one more
+    connection waits for one to be released. :connect, boto.connect_s3
+    by default, opens a connection.'''
+
+    # connections, unless given
+    SIZE = 16
+
+    def __init__(self, aws_access_key, aws_secret_key, size=None, connect=None):
+        self.aws_access_key = aws_access_key
+        self.aws_secret_key = aws_secret_key
+        self.size = size or self.SIZE
+        self.connect = connect
+        self.__reset()
+
+    def __reset(self):
+        '''Forget all connections, which may be those of a parent
+        process.'''
+        self.pid = os.getpid()
+        self.cond = threading.Condition(threading.Lock())
+        self.idle = []      # (pid, conn, {bucket name: bucket})
+        self.opened = 0
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def bucket(self, name):
+        '''Yield the S3 bucket :name on a connection of the pool, held
+        by this thread for the body. A use nested in the body gets the
+        same connection. A connection that fails, other than with an
+        error response from S3, is closed rather than returned to the
+        pool.'''
+        if self.pid != os.getpid():
+            self.__reset()
+        held = getattr(self.local, 'held', None)
+        if held:
+            yield self.__bucket(held, name)
+            return
+        c = self.__acquire()
+        self.local.held = c
+        ok = False
+        try:
+            yield self.__bucket(c, name)
+            ok = True
+        except boto.exception.BotoServerError:
+            ok = True
+            raise
+        finally:
+            self.local.held = None
+            self.__release(c, ok)
+
+    def __bucket(self, c, name):
+        b = c[2].get(name)
+        if not b:
+            b = c[2][name] = c[1].get_bucket(name)
+        return b
+
+    def __acquire(self):
+        with self.cond:
+            while not self.idle and self.opened >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        try:
+            connect = self.connect or boto.connect_s3
+            return (self.pid, connect(self.aws_access_key, self.aws_secret_key), {})
+        except:
+            self.__release(None, False)
+            raise
+
+    def __release(self, c, ok):
+        if c and c[0] != self.pid:
+            return
+        with self.cond:
+            if ok:
+                self.idle.append(c)
+            else:
+                self.opened -= 1
+                if c:
+                    try:
+                        c[1].close()
+                    except Exception:
+                        pass
+            self.cond.notify()
@@ -1,7 +1,9 @@
 import time, json, sys, os, calendar
 import boto
 import redis
-import StringIO, gzip, bisect
+import concurrent.futures
+import bisect, threading, contextlib, uuid
+import compression, cachepolicy, stats, connpool, iopool
 
 ### ------------------------------------------
 class Error(Exception):
@@ -15,128 +17,401 @@ class DataError(Error):
 
 
 ### ------------------------------------------
-def compress(s):
-    buf = StringIO.StringIO()
-    f = gzip.GzipFile(fileobj=buf, mode='wb')
-    try:
-        f.write(s)
-    finally:
-        f.close()
-    return buf.getvalue()
+def compress(s, codec='gzip'):
+    return compression.compress(s, codec)
 
 ### ------------------------------------------
 def uncompress(z):
-    buf = StringIO.StringIO(z)
-    f = gzip.GzipFile(fileobj=buf, mode='rb')
-    try:
-        s = f.read()
-    finally:
-        f.close()
-    return s
+    return compression.uncompress(z)
 
 
+# cached in Redis for a key not in S3
+NOT_FOUND = '-'
+
 ### ------------------------------------------
 class DocStore:
 
     ### ------------------------------------------
-    def __init__(self, s3_bucket, aws_access_key, aws_secret_key, redis_host, redis_port):
+    # seconds a key found missing in S3 is cached as such in Redis
+    NOT_FOUND_TTL = 60
+
+    # seconds to wait for another loader of a key
+    LOAD_TIMEOUT = 10
+
+    # keys per S3 listing request of list
+    LIST_PAGE = 1000
+
+    # threads for concurrent S3 reads and writes of getMany and
+    # putMany, unless given
+    IO_THREADS = 8
+
+    ### ------------------------------------------
+    def __init__(self, s3_bucket, aws_access_key, aws_secret_key, redis_host, redis_port,
+                 codec='gzip', cache_codec=None, cache_policy=None, metrics=None, redis_pool=None,
+                 s3_pool=None, io_threads=None, list_cache=None):
         self.redis_host = redis_host
         self.redis_port = int(redis_port)
         self.s3_bucket_name = s3_bucket
         self.aws_access_key = aws_access_key
         self.aws_secret_key = aws_secret_key
-        self.s3_bucket = None
-        self.s3_conn = None
+        self.redis_pool = redis_pool or connpool.redisPool(self.redis_host, self.redis_port)
+        self.s3_pool = s3_pool or connpool.S3Pool(aws_access_key, aws_secret_key)
         self.rconn = None
+        self.codec = codec
+        self.cache_codec = cache_codec or codec
+        compression.lookup(self.codec)
+        compression.lookup(self.cache_codec)
+        self.cache_policy = cache_policy or cachepolicy.CachePolicy()
+        self.metrics = metrics or stats.Metrics()
+        self.io_pool = iopool.IOPool(io_threads or self.IO_THREADS)
+        self.list_cache = list_cache
+        self.loading = {}   # key -> Future of the thread loading it
+        self.loading_lock = threading.Lock()
 
     ### ------------------------------------------
     def __s3_bucket_handle(self):
-        if not self.s3_conn:
-            self.s3_conn = boto.connect_s3(self.aws_access_key, self.aws_secret_key)
-        if not self.s3_bucket:
-            self.s3_bucket = self.s3_conn.get_bucket(self.s3_bucket_name)
-        return self.s3_bucket
+        return self.s3_pool.bucket(self.s3_bucket_name)
 
     ### ------------------------------------------
+    @contextlib.contextmanager
     def __s3_key_handle(self, keystr):
-        bkt = self.__s3_bucket_handle()
-        kk = boto.s3.key.Key(bkt)
-        kk.key = keystr
-        return kk
+        with self.s3_pool.bucket(self.s3_bucket_name) as bkt:
+            kk = bkt.new_key(keystr)
+            try:
+                yield kk
+            finally:
+                kk.close()
 
     ### ------------------------------------------
     def __rconn(self):
         if not self.rconn:
-            self.rconn = redis.StrictRedis(self.redis_host, self.redis_port)
+            self.rconn = redis.StrictRedis(connection_pool=self.redis_pool)
         return self.rconn
     
     ### ------------------------------------------
     def __rget(self, k):
-        return self.__rconn().get('docstore::' + k)
+        with self.metrics.timer('redis.get') as t:
+            z = self.__rconn().get('docstore::' + k)
+            t.nbytes = len(z or '')
+        return z
+
+    ### ------------------------------------------
+    def __rset(self, k, z, pipe=None):
+        if not self.cache_policy.fits(len(z)):
+            return self.__rdelete(k, pipe)
+        self.metrics.record('redis.set', nbytes=len(z))
+        return (pipe or self.__rconn()).setex('docstore::' + k, self.cache_policy.expiry(), z)
+
+    ### ------------------------------------------
+    def __rdelete(self, k, pipe=None):
+        return (pipe or self.__rconn()).delete('docstore::' + k)
 
     ### ------------------------------------------
-    def __rset(self, k, z):
-        return self.__rconn().setex('docstore::' + k, 30 * 24 * 60 * 60, z)
+    def __s3get(self, k):
+        '''Read compressed string for key k from S3, or None if not found.'''
+        try:
+            with self.__s3_key_handle(k) as kk:
+                with self.metrics.timer('s3.get') as t:
+                    z = kk.get_contents_as_string()
+                    t.nbytes = len(z)
+            return z
+        except boto.exception.S3ResponseError as e:
+            if e.status == 404: # not found error
+                return None
+            raise e
 
     ### ------------------------------------------
-    def __rdelete(self, k):
-        return self.__rconn().delete('docstore::' + k)
+    def __s3put(self, k, z):
+        with self.__s3_key_handle(k) as kk:
+            with self.metrics.timer('s3.put') as t:
+                kk.set_contents_from_string(z)
+                t.nbytes = len(z)
 
     ### ------------------------------------------
+    @stats.operation('put')
     def put(self, path, id, s):
-        z = compress(s)
+        with self.metrics.timer('compress') as t:
+            z = compress(s, self.codec)
+            t.nbytes = len(s)
         k = path + '/' + id + '.gz'
-        kk = self.__s3_key_handle(k);
-        try:
-            kk.set_contents_from_string(z)
-            # put (k, z) in redis
-            self.__rset(k, z)
-        finally:
-            kk.close()
+        self.__s3put(k, z)
+        # put (k, z) in redis, in the cache codec
+        with self.metrics.timer('compress'):
+            z = compression.recode(z, self.cache_codec, s)
+        pipe = self.__rconn().pipeline(transaction=False)
+        self.__rset(k, z, pipe)
+        self.__dropListings(k, pipe)
+        pipe.execute()
 
     ### ------------------------------------------
+    @stats.operation('get')
     def get(self, path, id):
         k = path + '/' + id + '.gz'
         z = self.__rget(k)
         if not z:
             # cache-miss. look in s3.
-            kk = self.__s3_key_handle(k);
+            self.metrics.record('redis.miss')
+            z = self.__load(k)
+        else:
+            self.metrics.record('redis.hit')
+        if z == NOT_FOUND:
+            return None
+        with self.metrics.timer('uncompress') as t:
+            s = uncompress(z)
+            t.nbytes = len(s)
+        return s
+
+    ### ------------------------------------------
+    def __load(self, k):
+        '''Load key k, missing in Redis, from S3 into Redis. Returns
+        the compressed string, or NOT_FOUND. Only one thread loads a
+        key; the others wait for its result.'''
+        with self.loading_lock:
+            f = self.loading.get(k)
+            mine = f is None
+            if mine:
+                f = self.loading[k] = concurrent.futures.Future()
+        if not mine:
             try:
-                z = kk.get_contents_as_string()
-                self.__rset(k, z)
-            except boto.exception.S3ResponseError as e:
-                if e.status == 404: # not found error
-                    self.__rdelete(k)
-                    return None
-                else:
-                    raise e
-            finally:
-                kk.close()
+                return f.result(self.LOAD_TIMEOUT)
+            except Exception:
+                return self.__fetch(k, False)
+        try:
+            z = self.__fetch(k, True)
+        except:
+            (t, v, tb) = sys.exc_info()
+            with self.loading_lock:
+                del self.loading[k]
+            f.set_exception_info(v, tb)
+            raise t, v, tb
+        with self.loading_lock:
+            del self.loading[k]
+        f.set_result(z)
+        return z
 
-        return uncompress(z)
+    ### ------------------------------------------
+    def __fetch(self, k, wait):
+        '''Fetch key k from S3 and put it in Redis. A key not in S3 is
+        put as NOT_FOUND for NOT_FOUND_TTL seconds; a put replaces it.
+        The key is fetched under a Redis lock; if another loader holds
+        it and :wait, poll Redis for its result instead, for at most
+        LOAD_TIMEOUT seconds.'''
+        lk = 'docstore::' + k + '::load'
+        locked = self.__rconn().set(lk, 1, nx=True, ex=self.LOAD_TIMEOUT)
+        if not locked and wait:
+            deadline = time.time() + self.LOAD_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(0.02)
+                z = self.__rget(k)
+                if z:
+                    return z
+                if not self.__rconn().exists(lk):
+                    break
+        try:
+            z = self.__s3get(k)
+            if z is None:
+                # do not hide a document put meanwhile
+                self.__rconn().set('docstore::' + k, NOT_FOUND, nx=True, ex=self.NOT_FOUND_TTL)
+                z = NOT_FOUND
+            else:
+                with self.metrics.timer('compress'):
+                    z = compression.recode(z, self.cache_codec)
+                if self.cache_policy.admit(self.__rconn(), 'docstore::', [('docstore::' + k, len(z))])[0]:
+                    self.__rset(k, z)
+        finally:
+            if locked:
+                self.__rconn().delete(lk)
+        return z
 
     ### ------------------------------------------
+    @stats.operation('getMany')
+    def getMany(self, path, ids):
+        '''Get the documents :ids under :path: those in Redis with one
+        MGET, the others from S3 concurrently, cached again in one
+        round trip. Returns a list of strings, or None for a document
+        not found, in the order of :ids. Unlike get, a document missing
+        in Redis is read without waiting for other loaders of it.'''
+        ks = [path + '/' + id + '.gz' for id in ids]
+        if not ks:
+            return []
+        with self.metrics.timer('redis.mget') as t:
+            zs = self.__rconn().mget(['docstore::' + k for k in ks])
+            t.nbytes = sum(len(z) for z in zs if z)
+        todo = [n for n in xrange(len(ks)) if not zs[n]]
+        self.metrics.record('redis.hit', n=len(ks) - len(todo))
+        if todo:
+            self.metrics.record('redis.miss', n=len(todo))
+            for (n, z) in zip(todo, self.__fetchMany([ks[n] for n in todo])):
+                zs[n] = z
+        out = []
+        for z in zs:
+            s = None
+            if z != NOT_FOUND:
+                with self.metrics.timer('uncompress') as t:
+                    s = uncompress(z)
+                    t.nbytes = len(s)
+            out.append(s)
+        return out
+
+    ### ------------------------------------------
+    def __fetchMany(self, ks):
+        '''Fetch keys ks from S3 concurrently, and put them in Redis in
+        one round trip, as __fetch does. Returns the compressed
+        strings, or NOT_FOUND, in the order of ks.'''
+        zs = self.io_pool.map(self.__s3get, [(k,) for k in ks])
+        found = [n for n in xrange(len(ks)) if zs[n] is not None]
+        with self.metrics.timer('compress'):
+            for n in found:
+                zs[n] = compression.recode(zs[n], self.cache_codec)
+        admitted = self.cache_policy.admit(self.__rconn(), 'docstore::',
+                                           [('docstore::' + ks[n], len(zs[n])) for n in found])
+        pipe = self.__rconn().pipeline(transaction=False)
+        for (n, ok) in zip(found, admitted):
+            if ok:
+                self.__rset(ks[n], zs[n], pipe)
+        for n in xrange(len(ks)):
+            if zs[n] is None:
+                # do not hide a document put meanwhile
+                pipe.set('docstore::' + ks[n], NOT_FOUND, nx=True, ex=self.NOT_FOUND_TTL)
+                zs[n] = NOT_FOUND
+        pipe.execute()
+        return zs
+
+    ### ------------------------------------------
+    @stats.operation('putMany')
+    def putMany(self, path, docs):
+        '''Put the documents :docs, a dict of id to string, under
+        :path: to S3 concurrently, then to Redis in one round trip. If
+        any S3 write fails, the documents are dropped from Redis and
+        the error is raised.'''
+        items = [(path + '/' + id + '.gz', s) for (id, s) in docs.items()]
+        zs = []
+        for (k, s) in items:
+            with self.metrics.timer('compress') as t:
+                zs.append(compress(s, self.codec))
+                t.nbytes = len(s)
+        pipe = self.__rconn().pipeline(transaction=False)
+        try:
+            self.io_pool.map(self.__s3put, [(k, z) for ((k, s), z) in zip(items, zs)])
+        except:
+            # some documents may have been written
+            for (k, s) in items:
+                self.__rdelete(k, pipe)
+                self.__dropListings(k, pipe)
+            pipe.execute()
+            raise
+        # put them in redis, in the cache codec
+        for ((k, s), z) in zip(items, zs):
+            with self.metrics.timer('compress'):
+                z = compression.recode(z, self.cache_codec, s)
+            self.__rset(k, z, pipe)
+            self.__dropListings(k, pipe)
+        pipe.execute()
+
+    ### ------------------------------------------
+    @stats.operation('delete')
     def delete(self, path, id):
         k = path + '/' + id + '.gz'
-        bkt = self.__s3_bucket_handle()
-        bkt.delete_key(k)
-        self.__rdelete(k)
+        with self.__s3_bucket_handle() as bkt:
+            bkt.delete_key(k)
+        pipe = self.__rconn().pipeline(transaction=False)
+        pipe.setex('docstore::' + k, self.NOT_FOUND_TTL, NOT_FOUND)
+        self.__dropListings(k, pipe)
+        pipe.execute()
 
     ### ------------------------------------------
+    @stats.operation('list')
     def list(self, path, limit):
-        bkt = self.__s3_bucket_handle()
-        rs = bkt.list(path)
+        '''Return the ids of the first :limit documents under :path,
+        a page of listPage at a time.'''
         out = []
-        if path[-1] == '/':
-            path = path[:-1]
-        for key in rs:
-            if limit == 0: break
-            id = key.name[len(path)+1:]
-            id = id[:-3]  # get rid of .gz
-            out += [id]
-            limit = limit - 1
+        marker = None
+        while len(out) < limit:
+            (ids, marker) = self.listPage(path, min(limit - len(out), self.LIST_PAGE), marker)
+            out += ids
+            if not marker:
+                break
         return out
 
+    ### ------------------------------------------
+    @stats.operation('listPage')
+    def listPage(self, path, limit=1000, marker=None, delimiter=None):
+        '''List the ids of at most :limit documents under :path, in key
+        order, from the :marker returned with the previous page, if
+        any. Returns (ids, marker); the marker is None after the last
+        page. With :delimiter, e.g. '/', documents further down are
+        listed once per path below :path, as that path followed by the
+        delimiter. With list_cache, the page is cached in Redis.'''
+        prefix = path + '/' if path and path[-1] != '/' else path
+        if self.list_cache:
+            rk = 'docstore::' + prefix + '::list'
+            field = json.dumps([limit, marker, delimiter])
+            (page, gen) = self.__rconn().hmget(rk, field, '#gen')
+            if page:
+                self.metrics.record('listcache.hit')
+                return tuple(json.loads(page))
+        with self.__s3_bucket_handle() as bkt:
+            with self.metrics.timer('s3.list'):
+                rs = bkt.get_all_keys(prefix=prefix, marker=marker or '', delimiter=delimiter or '',
+                                      max_keys=limit)
+        ids = []
+        for key in rs:
+            id = key.name[len(prefix):]
+            if id.endswith('.gz'):
+                id = id[:-3]  # get rid of .gz
+            ids += [id]
+        marker = None
+        if rs.is_truncated and ids:
+            marker = rs.next_marker or rs[-1].name
+        if self.list_cache:
+            self.__cacheListing(rk, field, [ids, marker], gen)
+        return (ids, marker)
+
+    ### ------------------------------------------
+    def __cacheListing(self, rk, field, page, gen):
+        '''Cache the listing :page in :field of the Redis hash rk, unless
+        a document under its path changed since the cache generation
+        :gen was read, before the listing.'''
+        with self.__rconn().pipeline() as pipe:
+            try:
+                pipe.watch(rk)
+                if pipe.hget(rk, '#gen') != gen:
+                    return
+                pipe.multi()
+                pipe.hset(rk, field, json.dumps(page))
+                pipe.expire(rk, self.list_cache)
+                pipe.execute()
+            except redis.WatchError:
+                pass
+
+    ### ------------------------------------------
+    def __dropListings(self, k, pipe):
+        '''Queue on :pipe the drop of the cached listing pages that may
+        hold key k: those of k's path and of every path above it. The
+        cache generation changes, so that pages listed before the drop
+        are not cached after it.'''
+        if not self.list_cache:
+            return
+        gen = uuid.uuid4().hex
+        for i in [-1] + [i for (i, c) in enumerate(k) if c == '/']:
+            rk = 'docstore::' + k[:i+1] + '::list'
+            pipe.delete(rk)
+            pipe.hset(rk, '#gen', gen)
+            pipe.expire(rk, self.list_cache)
+
+    ### ------------------------------------------
+    def statsSnapshot(self):
+        '''Return a snapshot of the metrics of this store; see
+        stats.Metrics.snapshot.'''
+        return self.metrics.snapshot()
+
+    ### ------------------------------------------
+    def cacheUsage(self):
+        '''Measure the Redis memory used by all document stores, which
+        share the docstore:: keys, and record it for the max_memory of
+        the cache policy. Returns {keys, bytes, time}.'''
+        return self.cache_policy.measure(self.__rconn(), 'docstore::')
+
     ### ------------------------------------------
     def _deleteFromCache(self, path, id):
         k = path + '/' + id + '.gz'
@@ -0,0 +1,55 @@
+'''The threads doing the concurrent I/O of the stores: a
+concurrent.futures.ThreadPoolExecutor that runs each call in the stats
+context of its caller.'''
+import os, sys, threading
+import concurrent.futures
+import stats
+
+### ------------------------------------------
+class IOPool:
+    '''An executor of at most :size threads, started as needed, and
+    made anew in a forked process. Calls must not wait on other calls
+    in the same pool, except through map().'''
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.__reset()
+
+    def __reset(self):
+        self.pid = os.getpid()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.size)
+
+    def pooled(self):
+        '''Tell whether the calling thread is a thread of the pool.'''
+        return getattr(self.local, 'pooled', False)
+
+    def map(self, fn, argslist):
+        '''Run fn(*args) for each args in :argslist concurrently, and
+        return the list of results. Every call finishes before the
+        first error, if any, is raised. On a pool thread, the calls are
+        run one after another on that thread instead.'''
+        if len(argslist) <= 1 or self.pooled():
+            return [fn(*args) for args in argslist]
+        futures = [self.submit(fn, *args) for args in argslist[1:]]
+        first = concurrent.futures.Future()
+        try:
+            first.set_result(fn(*argslist[0]))
+        except:
+            first.set_exception_info(*sys.exc_info()[1:])
+        concurrent.futures.wait(futures)
+        return [f.result() for f in [first] + futures]
+
+    def submit(self, fn, *args, **kw):
+        '''Run fn(*args, **kw) on a pool thread. Returns a
+        concurrent.futures.Future.'''
+        if self.pid != os.getpid():
+            # the threads of the parent process are not running here
+            self.__reset()
+        return self.executor.submit(self.__run, stats.context(), fn, args, kw)
+
+    def __run(self, ctx, fn, args, kw):
+        self.local.pooled = True
+        # count the work for the caller's operation
+        with stats.restored(ctx):
+            return fn(*args, **kw)
@@ -1,7 +1,10 @@
 import time, json, sys, os, calendar
 import boto
 import redis
-import StringIO, gzip, bisect
+import concurrent.futures
+import bisect, struct, array, base64, binascii
+import threading, uuid, collections, itertools, contextlib, copy
+import compression, cachepolicy, stats, connpool, iopool
 
 ### ------------------------------------------
 class Error(Exception):
@@ -24,7 +27,22 @@ class ListStoreIndexPage:
     '''An Index Page contains these fields:
     magic: "ListStoreIndexPage"
     version: 1
-    ymtab: htab of yyyymm ->  {yyyymm, total, seen, dismissed, ctime_max} records.
+    ymtab: htab of segment ->  {yyyymm, total, seen, dismissed, neither, ctime_max,
+                                unseen_range, undismissed_range, neither_range, flags,
+                                ctime_min} records.
+    A segment holds a run of rows of a period: month yyyymm, or year
+    yyyy once the months of the year are archived. The first segment
+    of a period is keyed by the period; when it gets too large, the
+    rows that follow go to segments yyyymm.001, yyyymm.002, and so on,
+    so that the keys sort in ctime order. The rows of an archived year
+    are all in its yyyy segments. ctime_min, of the segments after the
+    first only, is the ctime the segment starts at; it does not change
+    when rows are deleted, and goes down when rows are appended to the
+    segment after it was emptied.
+    neither is the # rows with neither flag set, and the *_range fields
+    are the [min, max] ctime of the unseen, undismissed and neither
+    rows, or null if there are none. flags tells if the segment has a
+    flag page. These fields are missing from older records.
     '''
     
     def __init__(self, jsonString):
@@ -49,281 +67,1398 @@ class ListStoreIndexPage:
     def toJson(self):
         return json.dumps(self.s)
 
+    def copy(self):
+        ip = ListStoreIndexPage('')
+        ip.s = copy.deepcopy(self.s)
+        ip.ymtab = ip.s['ymtab']
+        return ip
+
+    def ctimeMax(self):
+        '''Return the last ctime in the data pages, or 0.'''
+        return max([r['ctime_max'] for r in self.ymtab.values() if r['total'] > 0] + [0])
+
+    def segments(self, period):
+        '''Return the keys of the segments of :period, a month yyyymm
+        or a year yyyy, in ctime order.'''
+        return sorted(k for k in self.ymtab if segmentPeriod(k) == period)
+
+    def period(self, ctime):
+        '''Return the period whose segments hold the rows of :ctime: its
+        year if the year is archived, else its month.'''
+        yyyymm = unixTimeToYYYYMM(ctime)
+        if self.segments(yyyymm[:4]):
+            return yyyymm[:4]
+        return yyyymm
+
+    def segment(self, ctime):
+        '''Return the key of the segment that holds a row of :ctime, if
+        there is one: the last segment of its period starting at or
+        before it, or the period itself.'''
+        out = self.period(ctime)
+        for k in self.segments(out):
+            if self.ymtab[k].get('ctime_min', 0) <= ctime:
+                out = k
+        return out
+
+    @staticmethod
+    def qualified(r, skipSeen, skipDismissed):
+        '''Return the number of rows of ymtab record r that pass the
+        skipSeen/skipDismissed filters, or None if it is not known.'''
+        if skipSeen and skipDismissed:
+            if 'neither' in r:
+                return r['neither']
+            if r['seen'] == r['total'] or r['dismissed'] == r['total']:
+                return 0
+            if not r['seen']:
+                return r['total'] - r['dismissed']
+            if not r['dismissed']:
+                return r['total'] - r['seen']
+            return None
+        if skipSeen:
+            return r['total'] - r['seen']
+        if skipDismissed:
+            return r['total'] - r['dismissed']
+        return r['total']
+
+    @staticmethod
+    def span(r, skipSeen, skipDismissed):
+        '''Return the (min, max) ctime of the rows of ymtab record r
+        that pass the skipSeen/skipDismissed filters, or None if no row
+        does. If it is not known, min is -inf.'''
+        if ListStoreIndexPage.qualified(r, skipSeen, skipDismissed) == 0:
+            return None
+        if skipSeen and skipDismissed:
+            k = 'neither_range'
+        elif skipSeen:
+            k = 'unseen_range'
+        elif skipDismissed:
+            k = 'undismissed_range'
+        else:
+            k = None
+        if k in r:
+            return r[k] and tuple(r[k])
+        return (float('-inf'), r['ctime_max'])
+
+
+### ------------------------------------------
+# bitmap <-> one-byte-per-row flag conversion, 8 rows at a time
+_UNPACK = [bytes(bytearray((b >> k) & 1 for k in range(8))) for b in range(256)]
+_PACK = dict((u, b) for (b, u) in enumerate(_UNPACK))
+
+def packBits(flags):
+    '''Pack a bytearray of 0/1 values into a bitmap, LSB first.'''
+    f = bytes(flags) + b'\x00' * (-len(flags) % 8)
+    return bytearray(_PACK[f[i:i+8]] for i in xrange(0, len(f), 8))
+
+def unpackBits(bitmap, n):
+    '''Unpack n 0/1 values from a bitmap, LSB first.'''
+    return bytearray(b''.join(_UNPACK[b] for b in bytearray(bitmap))[:n])
+
+### ------------------------------------------
+def utf8(content):
+    '''Return :content, unicode or a utf-8 str, as a utf-8 str. Raise
+    DataError if it is neither.'''
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+    try:
+        content.decode('utf-8')
+    except (AttributeError, UnicodeDecodeError):
+        raise DataError('content is not utf-8')
+    return content
+
+### ------------------------------------------
+# an append log entry is ctime (float64, little endian) + content (utf-8)
+def packLogRow(ctime, content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return struct.pack('<d', ctime) + content
+
+def unpackLogRow(e):
+    return (struct.unpack_from('<d', e)[0], e[8:].decode('utf-8'))
+
+### ------------------------------------------
+class ListStoreFlagPage:
+    '''A Flag Page holds the flags of the rows of a Data Page, by
+    row position:
+    seen, dismissed: bytearray of 0/1 flags
+
+    On storage, little endian:
+    'LSFP', version 1 (uint16), n (uint32), seen bitmap, dismissed bitmap.'''
+
+    MAGIC = b'LSFP'
+    HEADER = struct.Struct('<4sHI')
+
+    def __init__(self, s):
+        self.seen = bytearray()
+        self.dismissed = bytearray()
+        if not s:
+            return
+        try:
+            (magic, version, n) = self.HEADER.unpack_from(s)
+        except struct.error:
+            raise DataError('bad flag page')
+        if magic != self.MAGIC or version != 1:
+            raise DataError('bad flag page')
+        nb = (n + 7) // 8
+        p = self.HEADER.size
+        self.seen = unpackBits(s[p:p + nb], n)
+        self.dismissed = unpackBits(s[p + nb:p + 2*nb], n)
+        if len(self.seen) != n or len(self.dismissed) != n:
+            raise DataError('bad flag page')
+
+    def toString(self):
+        return b''.join([self.HEADER.pack(self.MAGIC, 1, len(self)),
+                         bytes(packBits(self.seen)),
+                         bytes(packBits(self.dismissed))])
+
+    def __len__(self):
+        return len(self.seen)
+
+    def copy(self):
+        fp = ListStoreFlagPage('')
+        fp.seen = bytearray(self.seen)
+        fp.dismissed = bytearray(self.dismissed)
+        return fp
+
+    def resize(self, n):
+        '''Truncate to n rows, or extend with rows that have no flags set.'''
+        for f in (self.seen, self.dismissed):
+            if n < len(f):
+                del f[n:]
+            else:
+                f.extend(b'\x00' * (n - len(f)))
+
+    def remove(self, i):
+        if i < len(self):
+            del self.seen[i]
+            del self.dismissed[i]
+
+    def either(self):
+        '''Return a string of 0/1 bytes, 1 for rows with either flag set.'''
+        if not len(self):
+            return b''
+        either = (int(binascii.hexlify(bytes(self.seen)), 16)
+                  | int(binascii.hexlify(bytes(self.dismissed)), 16))
+        return binascii.unhexlify('%0*x' % (2 * len(self), either))
 
 ### ------------------------------------------
 class ListStoreDataPage:
-    '''A Data Page contains these fields:
-    magic: 'ListStoreDataPage'
-    version: 1
-    ctab: an array of {ctime, content, seen, dismissed} records.
-    The array is ordered by ctime ascending.'''
+    '''A Data Page holds the rows of a month ordered by ctime
+    ascending, in columns:
+    ctimes: array of float ctime
+    offsets, blob: content of row i is blob[offsets[i]:offsets[i+1]]
 
-    def __init__(self, jsonString):
-        if jsonString:
-            s = json.loads(jsonString)
-            if not isinstance(s, dict):
-                raise DataError('bad data page')
-            if not s.get('magic') == 'ListStoreDataPage':
-                raise DataError('bad data page')
-            if not s.get('version') == 1:
-                raise DataError('bad data page')
+    The flags of the rows are kept apart in a Flag Page, so that the
+    Data Page only changes when rows are added or deleted.
+
+    On storage it is version 3, little endian:
+    'LSDP', version (uint16), n (uint32),
+    n ctimes (float64), n+1 offsets (uint32), content blob (utf-8).
+
+    Older pages are still read, and are written back as version 3.
+    They carry the flags inline, which are loaded into self.flags:
+    version 2 is version 3 with the seen and dismissed bitmaps between
+    the ctimes and the offsets; version 1 is JSON of
+    {magic: 'ListStoreDataPage', version: 1,
+     ctab: [{ctime, content, seen, dismissed}, ...]}.'''
+
+    MAGIC = b'LSDP'
+    HEADER = struct.Struct('<4sHI')
+
+    def __init__(self, s):
+        self.ctimes = array.array('d')
+        self.offsets = array.array('I', [0])
+        self.blob = bytearray()
+        self.flags = None
+        if not s:
+            pass
+        elif s[:4] == self.MAGIC:
+            self.__fromString(s)
         else:
-            s = {'magic': 'ListStoreDataPage', 'version': 1, 'ctab': []}
+            self.__fromJson(s)
 
+    def __fromJson(self, jsonString):
+        s = json.loads(jsonString)
+        if not isinstance(s, dict):
+            raise DataError('bad data page')
+        if not s.get('magic') == 'ListStoreDataPage':
+            raise DataError('bad data page')
+        if not s.get('version') == 1:
+            raise DataError('bad data page')
         if not isinstance(s.get('ctab'), list):
             raise DataError('bad data page')
+        self.flags = ListStoreFlagPage('')
+        for r in s['ctab']:
+            self.append(r['ctime'], r['content'])
+            self.flags.seen.append(1 if r['seen'] else 0)
+            self.flags.dismissed.append(1 if r['dismissed'] else 0)
 
-        self.s = s
-        self.ctab = s['ctab']
+    def __fromString(self, s):
+        try:
+            (_, version, n) = self.HEADER.unpack_from(s)
+        except struct.error:
+            raise DataError('bad data page')
+        if version not in (2, 3):
+            raise DataError('bad data page')
+        p = self.HEADER.size
+        self.ctimes.fromstring(s[p:p + 8*n]); p += 8*n
+        if version == 2:
+            nb = (n + 7) // 8
+            self.flags = ListStoreFlagPage('')
+            self.flags.seen = unpackBits(s[p:p + nb], n); p += nb
+            self.flags.dismissed = unpackBits(s[p:p + nb], n); p += nb
+        self.offsets = array.array('I')
+        self.offsets.fromstring(s[p:p + 4*(n+1)]); p += 4*(n+1)
+        if sys.byteorder == 'big':
+            self.ctimes.byteswap()
+            self.offsets.byteswap()
+        self.blob = bytearray(s[p:])
+        if (len(self.ctimes) != n or len(self.offsets) != n + 1
+            or self.offsets[-1] != len(self.blob)):
+            raise DataError('bad data page')
 
+    def toString(self):
+        ctimes, offsets = self.ctimes, self.offsets
+        if sys.byteorder == 'big':
+            ctimes, offsets = array.array('d', ctimes), array.array('I', offsets)
+            ctimes.byteswap()
+            offsets.byteswap()
+        return b''.join([self.HEADER.pack(self.MAGIC, 3, len(self)),
+                         ctimes.tostring(),
+                         offsets.tostring(),
+                         bytes(self.blob)])
 
-    def toJson(self):
-        return json.dumps(self.s)
+    def __len__(self):
+        return len(self.ctimes)
+
+    def copy(self):
+        dp = ListStoreDataPage('')
+        dp.ctimes = array.array('d', self.ctimes)
+        dp.offsets = array.array('I', self.offsets)
+        dp.blob = bytearray(self.blob)
+        dp.flags = self.flags and self.flags.copy()
+        return dp
+
+    def content(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+
+    def row(self, i, fp):
+        return {'ctime': self.ctimes[i], 'content': self.content(i),
+                'seen': fp.seen[i], 'dismissed': fp.dismissed[i]}
+
+    def append(self, ctime, content):
+        content = utf8(content)
+        self.ctimes.append(ctime)
+        self.blob += content
+        self.offsets.append(len(self.blob))
+
+    def remove(self, i):
+        (a, b) = (self.offsets[i], self.offsets[i+1])
+        del self.blob[a:b]
+        del self.ctimes[i]
+        del self.offsets[i+1]
+        for j in xrange(i+1, len(self.offsets)):
+            self.offsets[j] -= (b - a)
+
+    def truncate(self, n):
+        if n < len(self):
+            del self.blob[self.offsets[n]:]
+            del self.ctimes[n:]
+            del self.offsets[n+1:]
 
     def index(self, ctime):
-        cta = [r['ctime'] for r in self.ctab]
-        i = bisect.bisect_left(cta, ctime)
-        found = (i < len(self.ctab) and self.ctab[i]['ctime'] == ctime)
+        i = bisect.bisect_left(self.ctimes, ctime)
+        found = (i < len(self) and self.ctimes[i] == ctime)
         return (i, found)
 
-    def find(self, ctime):
-        (i, found) = self.index(ctime)
-        if found:
-            return self.ctab[i]
-        return None
-
 ### ------------------------------------------
-def compress(s):
-    buf = StringIO.StringIO()
-    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
-        f.write(s)
-    return buf.getvalue()
+def compress(s, codec='gzip'):
+    return compression.compress(s, codec)
 
 ### ------------------------------------------
 def uncompress(z):
-    buf = StringIO.StringIO(z)
-    with gzip.GzipFile(fileobj=buf, mode='rb') as f:
-        s = f.read()
-    return s
+    return compression.uncompress(z)
+
+### ------------------------------------------
+class PageCache:
+    '''An in-process LRU cache of decoded pages, bounded by number
+    of pages and by bytes (the size of the uncompressed page). Each
+    entry is tagged with the version token found in Redis when it was
+    loaded, and is only served while that token is unchanged. Pages
+    are copied in and out, so that a caller may change the page it
+    gets, or has put, without affecting other threads.
+
+    A PageCache may be shared by several ListStore instances.'''
+
+    def __init__(self, max_pages=1000, max_bytes=64 * 1024 * 1024):
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.tab = collections.OrderedDict()   # k -> (version, page, nbytes)
+        self.lock = threading.Lock()
+
+    def version(self, k):
+        '''Return the version token of the entry for k, or None.'''
+        with self.lock:
+            e = self.tab.get(k)
+            return e and e[0]
+
+    def get(self, k, version):
+        '''Return the page cached for k if it is at :version.'''
+        with self.lock:
+            e = self.tab.pop(k, None)
+            if not e:
+                return None
+            if e[0] != version:
+                self.nbytes -= e[2]
+                return None
+            self.tab[k] = e
+        return e[1].copy()
+
+    def put(self, k, version, page, nbytes):
+        if nbytes <= self.max_bytes:
+            page = page.copy()
+        with self.lock:
+            e = self.tab.pop(k, None)
+            if e:
+                self.nbytes -= e[2]
+            if nbytes > self.max_bytes:
+                return
+            self.tab[k] = (version, page, nbytes)
+            self.nbytes += nbytes
+            while len(self.tab) > self.max_pages or self.nbytes > self.max_bytes:
+                _, e = self.tab.popitem(last=False)
+                self.nbytes -= e[2]
+
+    def discard(self, k):
+        with self.lock:
+            e = self.tab.pop(k, None)
+            if e:
+                self.nbytes -= e[2]
+
+    def clear(self):
+        with self.lock:
+            self.tab.clear()
+            self.nbytes = 0
+
+# cached in Redis for a key not in S3
+NOT_FOUND = '-'
 
 ### ------------------------------------------
 def unixTimeToYYYYMM(t):
     t = time.gmtime(t)
     return '%04d%02d' % (t.tm_year, t.tm_mon)
 
+### ------------------------------------------
+def segmentPeriod(seg):
+    '''Return the period, yyyymm or yyyy, of the segment key :seg.'''
+    return seg.partition('.')[0]
+
+### ------------------------------------------
+def globEscape(s):
+    '''Escape the Redis glob characters in :s.'''
+    return ''.join('\\' + c if c in '*?[]\\' else c for c in s)
+
 ### ------------------------------------------
 class ListStore:
 
     ### ------------------------------------------
-    def __init__(self, s3_bucket, aws_access_key, aws_secret_key, redis_host, redis_port):
+    # fold an append log when it gets this long
+    LOG_MAX = 1000
+
+    # threads for concurrent page reads and writes, unless given
+    IO_THREADS = 8
+
+    # seconds a key found missing in S3 is cached as such in Redis
+    NOT_FOUND_TTL = 60
+
+    # seconds to wait for another loader of a key
+    LOAD_TIMEOUT = 10
+
+    # keys per Redis SCAN and UNLINK, and per S3 multi-object delete,
+    # when purging lists
+    PURGE_BATCH = 1000
+
+    # rows, and bytes of content, after which the rows of a month go
+    # to a new segment
+    SEGMENT_ROWS = 10000
+    SEGMENT_BYTES = 4 * 1024 * 1024
+
+    # months after which archive() merges the months of a year
+    ARCHIVE_MONTHS = 12
+
+    # seconds after which archive() deletes the pages it replaced, by
+    # when no writer still holds the index page pointing to them
+    ARCHIVE_GRACE = 600
+
+    ### ------------------------------------------
+    def __init__(self, s3_bucket, aws_access_key, aws_secret_key, redis_host, redis_port, page_cache=None,
+                 write_behind=None, append_log=None, codec='gzip', cache_codec=None, cache_policy=None,
+                 metrics=None, row_cache=None, io_threads=None, redis_pool=None, s3_pool=None):
         self.redis_host = redis_host
         self.redis_port = int(redis_port)
         self.s3_bucket_name = s3_bucket
         self.aws_access_key = aws_access_key
         self.aws_secret_key = aws_secret_key
-        self.s3_bucket = None
-        self.s3_conn = None
+        self.redis_pool = redis_pool or connpool.redisPool(self.redis_host, self.redis_port)
+        self.s3_pool = s3_pool or connpool.S3Pool(aws_access_key, aws_secret_key)
         self.rconn = None
+        self.page_cache = page_cache
+        self.write_behind = write_behind
+        self.append_log = append_log
+        self.row_cache = row_cache
+        self.codec = codec
+        self.cache_codec = cache_codec or codec
+        compression.lookup(self.codec)
+        compression.lookup(self.cache_codec)
+        self.cache_policy = cache_policy or cachepolicy.CachePolicy()
+        self.metrics = metrics or stats.Metrics()
+        self.io_pool = iopool.IOPool(io_threads or self.IO_THREADS)
+        self.flusher = None
+        self.flusher_pid = None
+        self.flusher_stop = threading.Event()
+        self.loading = {}   # key -> Future of the thread loading it
+        self.loading_lock = threading.Lock()
 
     ### ------------------------------------------
     def __s3_bucket_handle(self):
-        if not self.s3_conn:
-            self.s3_conn = boto.connect_s3(self.aws_access_key, self.aws_secret_key)
-        if not self.s3_bucket:
-            self.s3_bucket = self.s3_conn.get_bucket(self.s3_bucket_name)
-        return self.s3_bucket
+        '''Hold a connection of the S3 pool for the body of a with
+        statement; yields the S3 bucket.'''
+        return self.s3_pool.bucket(self.s3_bucket_name)
 
     ### ------------------------------------------
+    @contextlib.contextmanager
     def __s3_key_handle(self, keystr):
-        bkt = self.__s3_bucket_handle()
-        kk = boto.s3.key.Key(bkt)
-        kk.key = keystr
-        return kk
+        with self.s3_pool.bucket(self.s3_bucket_name) as bkt:
+            kk = bkt.new_key(keystr)
+            try:
+                yield kk
+            finally:
+                kk.close()
 
     ### ------------------------------------------
     def __rconn(self):
-        '''Get a Redis connection.'''
+        '''Get a Redis client, on the connections of the Redis pool.'''
         if not self.rconn:
-            self.rconn = redis.StrictRedis(self.redis_host, self.redis_port)
+            self.rconn = redis.StrictRedis(connection_pool=self.redis_pool)
         return self.rconn
     
     ### ------------------------------------------
-    def __rget(self, k):
-        '''Read bytea in Redis named by key k'''
-        return self.__rconn().get('liststore::%s::%s' % (self.s3_bucket_name, k))
+    def __rkey(self, k):
+        '''Map key k to its Redis key.'''
+        return 'liststore::%s::%s' % (self.s3_bucket_name, k)
+
+    ### ------------------------------------------
+    def __rget(self, ks):
+        '''Read bytea in Redis named by keys ks, and their version
+        tokens, in one round trip. Returns a list of (bytea, token).'''
+        rks = []
+        for k in ks:
+            rks += [self.__rkey(k), self.__rkey(k) + '::ver']
+        with self.metrics.timer('redis.mget') as t:
+            vals = self.__rconn().mget(rks)
+            t.nbytes = sum(len(v) for v in vals if v)
+        return [(vals[n], vals[n+1]) for n in xrange(0, len(vals), 2)]
+
+    ### ------------------------------------------
+    def __ttl(self, k):
+        '''Return the Redis TTL of key k, by the age of its month, or
+        of the last month of its year, if k is a data or flag page.'''
+        (name, slash, base) = k.rpartition('/')
+        yyyymm = segmentPeriod(base)
+        if len(yyyymm) == 4:
+            yyyymm = yyyymm + '12'
+        if not slash or not yyyymm.isdigit():
+            yyyymm = None
+        return self.cache_policy.expiry(yyyymm)
 
     ### ------------------------------------------
-    def __rset(self, k, s):
-        '''Save key k -> bytea s in Redis. Expires in 30 days.'''
-        return self.__rconn().setex('liststore::%s::%s' % (self.s3_bucket_name, k), 30 * 24 * 60 * 60, s)
+    def __rset(self, k, s, dirty=False, pipe=None):
+        '''Save key k -> bytea s in Redis under a new version
+        token, to expire as the cache policy says. Returns the token.
+        If s is too large for the cache policy, k is dropped from Redis
+        instead, and None is returned.
+
+        If :dirty, s is not in S3 yet: k is marked dirty for the
+        flusher, and does not expire until it is flushed.
+
+        If :pipe is given, the commands are queued on it, and the
+        caller executes it.'''
+        rk = self.__rkey(k)
+        ver = uuid.uuid4().hex
+        self.metrics.record('redis.set', nbytes=len(s))
+        p = pipe or self.__rconn().pipeline()
+        if dirty:
+            p.set(rk, s)
+            p.set(rk + '::ver', ver)
+            # keep the time k first became dirty
+            p.execute_command('ZADD', self.__rkey('dirty'), 'NX', time.time(), k)
+        elif not self.cache_policy.fits(len(s)):
+            p.delete(rk, rk + '::ver')
+            ver = None
+        else:
+            ttl = self.__ttl(k)
+            p.setex(rk, ttl, s)
+            p.setex(rk + '::ver', ttl, ver)
+        if not pipe:
+            p.execute()
+        return ver
 
     ### ------------------------------------------
     def __rdelete(self, k):
         '''Delete key k in Redis.'''
-        return self.__rconn().delete('liststore::%s::%s' % (self.s3_bucket_name, k))
+        rk = self.__rkey(k)
+        return self.__rconn().delete(rk, rk + '::ver')
 
 
     ### ------------------------------------------
-    def __write(self, k, s):
-        '''Write key k -> compressed string s in S3 and Redis.'''
-        z = compress(s)
+    def __write(self, k, s, page=None, pipe=None):
+        '''Write key k -> compressed string s in S3 and Redis. If
+        :page is given, it is the decoded form of s and is kept in the
+        page cache. If :pipe is given, the Redis write is added to the
+        commands queued on it, and executed with them; their results
+        are returned.'''
+        with self.metrics.timer('compress') as t:
+            zc = compress(s, self.cache_codec)
+            t.nbytes = len(s)
         k = k + '.gz'
-        kk = self.__s3_key_handle(k)
+        res = None
+        if self.write_behind is not None:
+            # put (k, zc) in redis only; the flusher writes it to s3.
+            try:
+                ver = self.__rset(k, zc, dirty=True, pipe=pipe)
+                if pipe:
+                    res = pipe.execute()
+            except:
+                self.__discard(k)
+                raise
+            self.__startFlusher()
+        else:
+            with self.metrics.timer('compress') as t:
+                z = compression.recode(zc, self.codec, s)
+            try:
+                with self.__s3_key_handle(k) as kk:
+                    with self.metrics.timer('s3.put') as t:
+                        kk.set_contents_from_string(z)
+                        t.nbytes = len(z)
+                # put (k, zc) in redis
+                ver = self.__rset(k, zc, pipe=pipe)
+                if pipe:
+                    res = pipe.execute()
+            except:
+                self.__discard(k)
+                raise
+        if self.page_cache and page is not None and ver:
+            self.page_cache.put(self.__rkey(k), ver, page, len(s))
+        return res
+
+    ### ------------------------------------------
+    def __s3get(self, k):
+        '''Read compressed string for key k from S3, or None if not found.'''
         try:
-            kk.set_contents_from_string(z)
-            # put (k, z) in redis
-            self.__rset(k, z)
-        finally:
-            kk.close()
+            with self.__s3_key_handle(k) as kk:
+                with self.metrics.timer('s3.get') as t:
+                    z = kk.get_contents_as_string()
+                    t.nbytes = len(z)
+            return z
+        except boto.exception.S3ResponseError as e:
+            if e.status == 404: # not found error
+                return None
+            raise e
 
     ### ------------------------------------------
-    def __read(self, k):
-        '''Read compressed string for key k from Redis or S3.'''
-        k = k + '.gz'
-        z = self.__rget(k)
-        if not z:
+    def __read(self, ks):
+        '''Read compressed strings for keys ks from Redis, in one round
+        trip, or from S3, concurrently. Returns a list of (uncompressed
+        string, version token), or (None, None) for a key not found.'''
+        ks = [k + '.gz' for k in ks]
+        out = self.__rget(ks)
+        miss = [n for n in xrange(len(ks)) if not out[n][0]]
+        self.metrics.record('redis.hit', n=len(ks) - len(miss))
+        if miss:
             # cache-miss. look in s3.
-            kk = self.__s3_key_handle(k);
-            try:
-                z = kk.get_contents_as_string()
-                self.__rset(k, z)
-            except boto.exception.S3ResponseError as e:
-                if e.status == 404: # not found error
-                    self.__rdelete(k)
-                    return None
+            self.metrics.record('redis.miss', n=len(miss))
+            for (n, r) in zip(miss, self.__load([ks[n] for n in miss])):
+                out[n] = r
+        with self.metrics.timer('uncompress') as t:
+            out = [(None, None) if z in (None, NOT_FOUND) else (uncompress(z), ver)
+                   for (z, ver) in out]
+            t.nbytes = sum(len(s) for (s, ver) in out if s)
+        return out
+
+    ### ------------------------------------------
+    def __load(self, ks):
+        '''Load keys ks, missing in Redis, from S3 into Redis. Returns
+        a list of (z, token), or (NOT_FOUND, None) for a key not in S3.
+
+        A key being loaded by another thread is waited for rather than
+        fetched again. Threads of the I/O pool do not wait; they only
+        read ahead.'''
+        pooled = self.io_pool.pooled()
+        out = [None] * len(ks)
+        mine, theirs = [], []
+        with self.loading_lock:
+            for (n, k) in enumerate(ks):
+                if pooled:
+                    mine += [n]
+                elif k in self.loading:
+                    theirs += [(n, self.loading[k])]
                 else:
-                    raise e
-            finally:
-                kk.close()
+                    self.loading[k] = concurrent.futures.Future()
+                    mine += [n]
+        err = None
+        try:
+            got = self.__fetch([ks[n] for n in mine], not pooled)
+            for (n, r) in zip(mine, got):
+                out[n] = r
+        except:
+            err = sys.exc_info()
+            raise
+        finally:
+            if not pooled:
+                # hand the result to the threads waiting for it
+                with self.loading_lock:
+                    for n in mine:
+                        f = self.loading.pop(ks[n])
+                        if err:
+                            f.set_exception_info(*err[1:])
+                        else:
+                            f.set_result(out[n])
+        for (n, f) in theirs:
+            try:
+                out[n] = f.result(self.LOAD_TIMEOUT)
+            except Exception:
+                out[n] = self.__fetch([ks[n]], False)[0]
+        return out
 
-        return uncompress(z)
+    ### ------------------------------------------
+    def __fetch(self, ks, wait):
+        '''Fetch keys ks from S3, concurrently, and put them in Redis.
+        A key not in S3 is put as NOT_FOUND for NOT_FOUND_TTL seconds;
+        a write replaces it. Each key is fetched under a Redis lock; a
+        key locked by another loader is polled for instead if :wait,
+        for at most LOAD_TIMEOUT seconds. Returns a list of (z,
+        token).'''
+        if not ks:
+            return []
+        out = [None] * len(ks)
+        lks = [self.__rkey(k) + '::load' for k in ks]
+        pipe = self.__rconn().pipeline(transaction=False)
+        for lk in lks:
+            pipe.set(lk, 1, nx=True, ex=self.LOAD_TIMEOUT)
+        locked = pipe.execute()
+
+        # wait for the other loaders
+        polls = [n for n in xrange(len(ks)) if wait and not locked[n]]
+        deadline = time.time() + self.LOAD_TIMEOUT
+        while polls:
+            time.sleep(0.02)
+            for (n, r) in zip(polls, self.__rget([ks[n] for n in polls])):
+                if r[0]:
+                    out[n] = r
+            polls = [n for n in polls if out[n] is None]
+            if polls and time.time() < deadline:
+                # keep polling the keys still locked
+                held = self.__rconn().mget([lks[n] for n in polls])
+                polls = [n for (n, h) in zip(polls, held) if h]
+            else:
+                break
+
+        todo = [n for n in xrange(len(ks)) if out[n] is None]
+        zs = self.io_pool.map(self.__s3get, [(ks[n],) for n in todo])
+        with self.metrics.timer('compress'):
+            zs = [z and compression.recode(z, self.cache_codec) for z in zs]
+        admit = self.cache_policy.admit(self.__rconn(), self.__rkey(''),
+                                        [(self.__rkey(ks[n]), len(z)) for (n, z) in zip(todo, zs) if z])
+        admit = iter(admit)
+        pipe = self.__rconn().pipeline()
+        for (n, z) in zip(todo, zs):
+            if z is None:
+                # do not hide a page written meanwhile
+                pipe.set(self.__rkey(ks[n]), NOT_FOUND, nx=True, ex=self.NOT_FOUND_TTL)
+                out[n] = (NOT_FOUND, None)
+            elif next(admit):
+                # put (k, z) in redis, in the cache codec
+                out[n] = (z, self.__rset(ks[n], z, pipe=pipe))
+            else:
+                out[n] = (z, None)
+        for n in xrange(len(ks)):
+            if locked[n]:
+                pipe.delete(lks[n])
+        pipe.execute()
+        return out
+
+    ### ------------------------------------------
+    def __readPages(self, reqs):
+        '''Read keys k and decode them as :cls pages, for each (k, cls)
+        in :reqs. With a page cache, a page whose version token in Redis
+        is unchanged is served without fetching, uncompressing or
+        parsing it again.'''
+        out = [None] * len(reqs)
+        todo = range(len(reqs))
+        rks = [self.__rkey(k + '.gz') for (k, cls) in reqs]
+        if self.page_cache:
+            cached = [n for n in todo if self.page_cache.version(rks[n])]
+            if cached:
+                vers = self.__rconn().mget([rks[n] + '::ver' for n in cached])
+                for (n, ver) in zip(cached, vers):
+                    out[n] = self.page_cache.get(rks[n], ver)
+                todo = [n for n in todo if out[n] is None]
+                self.metrics.record('pagecache.hit', n=sum(1 for n in cached if out[n] is not None))
+        if todo:
+            for (n, (s, ver)) in zip(todo, self.__read([reqs[n][0] for n in todo])):
+                with self.metrics.timer('decode') as t:
+                    out[n] = reqs[n][1](s)
+                    t.nbytes = len(s or '')
+                if self.page_cache and ver:
+                    self.page_cache.put(rks[n], ver, out[n], len(s))
+        return out
+
+    ### ------------------------------------------
+    def __readPage(self, k, cls):
+        return self.__readPages([(k, cls)])[0]
+
+    ### ------------------------------------------
+    def __discard(self, k):
+        '''Drop the page cache entry for key k (with the .gz suffix).'''
+        if self.page_cache:
+            self.page_cache.discard(self.__rkey(k))
+
+    ### ------------------------------------------
+    def __startFlusher(self):
+        if self.flusher_pid != os.getpid():
+            # the flusher of the parent process is not running here
+            self.flusher = None
+        if self.flusher or self.flusher_stop.is_set():
+            return
+        self.flusher_pid = os.getpid()
+        self.flusher = threading.Thread(target=self.__flushLoop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    ### ------------------------------------------
+    def __flushLoop(self):
+        '''Body of the flusher thread: fold append logs, and write
+        dirty pages to S3. A failed round is logged, counted as
+        flush.error, and retried in the next.'''
+        delays = [d for d in (self.write_behind, self.append_log) if d is not None]
+        while not self.flusher_stop.wait(max(min(delays) / 2.0, 0.1)):
+            try:
+                if self.append_log is not None:
+                    self.compact(age=self.append_log)
+                if self.write_behind is not None:
+                    self.flush(age=self.write_behind)
+            except Exception:
+                # leave the logs and pages dirty; retry in the next round.
+                self.metrics.error('flush.error', 'flusher of bucket %s failed', self.s3_bucket_name)
+
+    ### ------------------------------------------
+    @stats.operation('flush')
+    def flush(self, name=None, age=0):
+        '''In write-behind mode, write to S3 the pages of list :name
+        (or of all lists if None) that have been dirty for at least
+        :age seconds. A page that changes again while being written
+        stays dirty. A separate process may run this periodically in
+        place of the flusher thread.'''
+        dk = self.__rkey('dirty')
+        for k in self.__rconn().zrangebyscore(dk, '-inf', time.time() - age):
+            if name is not None and k != name + '.gz' and not k.startswith(name + '/'):
+                continue
+            rk = self.__rkey(k)
+            with self.__rconn().pipeline() as pipe:
+                try:
+                    pipe.watch(rk + '::ver')
+                    (z, ver) = pipe.mget(rk, rk + '::ver')
+                    if z:
+                        with self.metrics.timer('compress'):
+                            zs3 = compression.recode(z, self.codec)
+                        with self.__s3_key_handle(k) as kk:
+                            with self.metrics.timer('s3.put') as t:
+                                kk.set_contents_from_string(zs3)
+                                t.nbytes = len(zs3)
+                    pipe.multi()
+                    pipe.zrem(dk, k)
+                    if z and self.cache_policy.fits(len(z)):
+                        pipe.expire(rk, self.__ttl(k))
+                        pipe.expire(rk + '::ver', self.__ttl(k))
+                    elif z:
+                        pipe.delete(rk, rk + '::ver')
+                    pipe.execute()
+                except redis.WatchError:
+                    pass
+
+    ### ------------------------------------------
+    def close(self):
+        '''Stop the flusher thread, fold all append logs and write all
+        dirty pages to S3. Call this before shutting down in
+        write-behind or append-log mode.'''
+        self.flusher_stop.set()
+        if self.flusher:
+            self.flusher.join()
+            self.flusher = None
+        if self.append_log is not None:
+            self.compact()
+        if self.write_behind is not None:
+            self.flush()
+        self.flusher_stop.clear()
 
     ### ------------------------------------------
     def __readIndexPage(self, name):
-        return ListStoreIndexPage(self.__read(name))
+        return self.__readPage(name, ListStoreIndexPage)
+
+    ### ------------------------------------------
+    def __writeIndexPage(self, name, ip, pipe=None):
+        '''Write the index page of list :name, and set the counters of
+        the list from it in the same Redis transaction. Commands queued
+        on :pipe are executed in that transaction too, and their
+        results returned.'''
+        ck = self.__rkey(name + '.count')
+        pipe = pipe or self.__rconn().pipeline()
+        pipe.hmset(ck, self.__count(ip, []))
+        pipe.expire(ck, self.cache_policy.expiry())
+        try:
+            return self.__write(name, ip.toJson(), ip, pipe)
+        except:
+            # the counters may not match the index page
+            (t, v, tb) = sys.exc_info()
+            try:
+                self.__rconn().delete(ck)
+            except redis.RedisError:
+                pass
+            raise t, v, tb
 
     ### ------------------------------------------
-    def __writeIndexPage(self, name, ip):
-        return self.__write(name, ip.toJson())
+    def __readMonths(self, reqs):
+        '''Read the data page and the flags of the rows in it, for each
+        (name, segment, ip) in :reqs. All pages are read together.
+        Returns a list of (dp, fp).'''
+        pages = []
+        for (name, yyyymm, ip) in reqs:
+            r = ip.ymtab.get(yyyymm)
+            if r:
+                pages += [(name + '/' + yyyymm, ListStoreDataPage)]
+                if r.get('flags'):
+                    pages += [(name + '/' + yyyymm + '.flags', ListStoreFlagPage)]
+        pages = iter(self.__readPages(pages))
+
+        out = []
+        for (name, yyyymm, ip) in reqs:
+            r = ip.ymtab.get(yyyymm)
+            if not r:
+                out += [(ListStoreDataPage(''), ListStoreFlagPage(''))]
+                continue
+            dp = next(pages)
+            # fix up dp to be consistent with r
+            dp.truncate(r['total'])
+            # pages written before flags were split out still carry
+            # them inline
+            if r.get('flags'):
+                fp = next(pages)
+            elif dp.flags:
+                fp = dp.flags.copy()
+            else:
+                fp = ListStoreFlagPage('')
+            fp.resize(len(dp))
+            out += [(dp, fp)]
+        return out
 
     ### ------------------------------------------
-    def __readDataPage(self, name, yyyymm):
-        ip = self.__readIndexPage(name)
-        r = ip.ymtab.get(yyyymm)
-        if not r:
-            return ListStoreDataPage('')
-        dp = ListStoreDataPage(self.__read(name + '/' + yyyymm))
-        # fix up dp to be consistent with r
-        if len(dp.ctab) > r['total']:
-            dp.s['ctab'] = dp.ctab[:r['total']]
-            dp.ctab = dp.s['ctab'] 
-        return dp
+    def __readMonth(self, name, yyyymm, ip):
+        '''Read the data page and the flag page of a month.'''
+        return self.__readMonths([(name, yyyymm, ip)])[0]
 
     ### ------------------------------------------
-    def __writeDataPage(self, name, yyyymm, dp):
-        ip = self.__readIndexPage(name)
+    def __setIndexEntry(self, ip, seg, dp, fp, flags):
         # compute total, seen, dismissed, ctime_max
-        seen, dismissed = 0, 0
-        total = len(dp.ctab)
-        ctime_max = 0
-        for i in dp.ctab:
-            if i['seen']: seen = seen + 1
-            if i['dismissed']: dismissed = dismissed + 1
-            if ctime_max < i['ctime']: ctime_max = i['ctime']
+        old = ip.ymtab.get(seg) or {}
+        yyyymm = segmentPeriod(seg)
+        total = len(dp)
+        seen = fp.seen.count(b'\x01')
+        dismissed = fp.dismissed.count(b'\x01')
+        ctime_max = dp.ctimes[-1] if total else old.get('ctime_min', 0)
         if ctime_max <= 0:
-            ctime_max = calendar.timegm(time.strptime(yyyymm + '01', '%Y%m%d'))
+            ctime_max = calendar.timegm(time.strptime((yyyymm + '0101')[:8], '%Y%m%d'))
+
+        either = fp.either()
+
+        def span(f):
+            # [min, max] ctime of the rows without flag f
+            lo = f.find(b'\x00')
+            if lo < 0:
+                return None
+            return [dp.ctimes[lo], dp.ctimes[f.rfind(b'\x00')]]
 
         r = {'yyyymm': yyyymm, 'total': total, 
 		'seen': seen, 'dismissed': dismissed, 
-		'ctime_max': ctime_max}
-        ip.ymtab[yyyymm] = r
+		'neither': total - either.count(b'\x01'), 'ctime_max': ctime_max,
+		'unseen_range': span(fp.seen),
+		'undismissed_range': span(fp.dismissed),
+		'neither_range': span(either)}
+        if flags:
+            r['flags'] = 1
+        if seg != yyyymm:
+            r['ctime_min'] = old.get('ctime_min') or ctime_max
+            if total:
+                # rows appended to an emptied segment may come before it
+                r['ctime_min'] = min(r['ctime_min'], dp.ctimes[0])
+        ip.ymtab[seg] = r
 
-        # write data page to s3
-        self.__write(name + '/' + yyyymm, dp.toJson())
+    ### ------------------------------------------
+    def __writeDataPages(self, name, ip, pages, pipe=None):
+        '''Write the data pages of pages {yyyymm: (dp, fp, flagsDirty)}
+        after rows were added or removed, then the index page. A flag
+        page is written too if flagsDirty (rows moved), or if the flags
+        were inline in dp and some are set. Commands queued on :pipe
+        are executed with the Redis write of the index page, and their
+        results returned.
 
-        # write index page to s3
-        self.__writeIndexPage(name, ip)
-        
+        The pages are written concurrently on the I/O pool, and the
+        index page after all of them, so that it never points to a page
+        not written yet.'''
+        try:
+            writes = []
+            for yyyymm in sorted(pages.keys()):
+                (dp, fp, flagsDirty) = pages[yyyymm]
+                r = ip.ymtab.get(yyyymm) or {}
+                fp.resize(len(dp))
+                if r.get('flags'):
+                    writeFlags = flagsDirty
+                else:
+                    writeFlags = (fp.seen.find(b'\x01') >= 0 or fp.dismissed.find(b'\x01') >= 0)
+                self.__setIndexEntry(ip, yyyymm, dp, fp, r.get('flags') or writeFlags)
+                writes += [(name + '/' + yyyymm, dp.toString(), dp)]
+                if writeFlags:
+                    writes += [(name + '/' + yyyymm + '.flags', fp.toString(), fp)]
+            self.io_pool.map(self.__write, writes)
+
+            # write index page to s3
+            return self.__writeIndexPage(name, ip, pipe)
+        except:
+            # ip was modified but not saved
+            self.__discard(name + '.gz')
+            raise
 
     ### ------------------------------------------
-    def __append(self, name, yyyymm, newrows):
-        # sort by ctime
-        newrows.sort(key = lambda x: x[0])
+    def __writeFlagPages(self, name, ip, pages, pipe=None):
+        '''Write the flag pages of pages {yyyymm: (dp, fp)} after flags
+        were set, concurrently, then the index page. The data pages are
+        left alone. Commands queued on :pipe are executed with the Redis
+        write of the index page.'''
+        if not pages:
+            return
+        try:
+            writes = []
+            for yyyymm in sorted(pages.keys()):
+                (dp, fp) = pages[yyyymm]
+                self.__setIndexEntry(ip, yyyymm, dp, fp, 1)
+                writes += [(name + '/' + yyyymm + '.flags', fp.toString(), fp)]
+            self.io_pool.map(self.__write, writes)
+            self.__writeIndexPage(name, ip, pipe)
+        except:
+            # ip was modified but not saved
+            self.__discard(name + '.gz')
+            raise
 
-        ip = self.__readIndexPage(name)
-        for _, r in ip.ymtab.items():
-            if r['total'] > 0 and r['ctime_max'] >= newrows[0][0]:
+    ### ------------------------------------------
+    def __appendRows(self, name, ip, rows, pipe=None):
+        '''Append rows [(ctime, content), ...], sorted by ctime and
+        later than any row in ip, to the data pages of list :name. Rows
+        go to the last segment of their period, or to a new one when it
+        has SEGMENT_ROWS rows or SEGMENT_BYTES of content. Returns the
+        results of the commands queued on :pipe.'''
+        # group rows by period
+        g = {}
+        for (ctime, content) in rows:
+            g.setdefault(ip.period(ctime), []).append((ctime, content))
+
+        # read the last segment of each period, append, and write them
+        pages = {}
+        periods = sorted(g.keys())
+        last = [(ip.segments(i) or [i])[-1] for i in periods]
+        for (period, seg, (dp, fp)) in zip(periods, last, self.__readMonths([(name, k, ip) for k in last])):
+            if len(dp) and dp.ctimes[-1] >= g[period][0][0]:
                 raise NonFutureItemError()
+            pages[seg] = (dp, fp, False)
+            for (ctime, content) in g[period]:
+                if self.__full(dp, content):
+                    seg = self.__nextSegment(seg)
+                    (dp, fp) = (ListStoreDataPage(''), ListStoreFlagPage(''))
+                    pages[seg] = (dp, fp, False)
+                dp.append(ctime, content)
+        return self.__writeDataPages(name, ip, pages, pipe)
 
-        # read the page, append, and write it
-        dp = self.__readDataPage(name, yyyymm)
-        if len(dp.ctab) and dp.ctab[-1]['ctime'] >= newrows[0][0]:
-            raise NonFutureItemError()
-        for (ctime, content) in newrows:
-            dp.ctab += [ {'ctime':ctime, 'content':content, 
-				'seen':0, 'dismissed':0} ]
-        self.__writeDataPage(name, yyyymm, dp)
+    ### ------------------------------------------
+    def __full(self, dp, content):
+        '''Tell whether data page dp is too large to take a row of
+        :content.'''
+        if not len(dp):
+            return False
+        nbytes = len(content.encode('utf-8') if isinstance(content, unicode) else content)
+        return len(dp) >= self.SEGMENT_ROWS or len(dp.blob) + nbytes > self.SEGMENT_BYTES
 
     ### ------------------------------------------
+    @staticmethod
+    def __nextSegment(seg):
+        '''Return the key of the segment after :seg in its period.'''
+        (yyyymm, dot, n) = seg.partition('.')
+        return '%s.%03d' % (yyyymm, int(n or 0) + 1)
+
+    ### ------------------------------------------
+    @stats.operation('append')
     def append(self, name, rows):
         '''Append a batch of new records into the store in list
         :name. If the list does not exist, it will be created
         automatically.  Each record is a (:ctime, :content) tuple.  If
         any of the new records have a ctime that is younger than last
         known ctime for this list, a NonFutureEventError will be
-        raise.
+        raise. Content that is neither unicode nor a utf-8 str raises
+        a DataError, and nothing is appended.
         '''
-        # group rows by month
+        rows = sorted([(ctime, utf8(content)) for (ctime, content) in rows], key = lambda x: x[0])
+        if not rows:
+            return
+        if self.append_log is not None:
+            return self.__logAppend(name, rows)
+        ip = self.__readIndexPage(name)
+        if ip.ctimeMax() >= rows[0][0]:
+            raise NonFutureItemError()
+        pipe = self.__rconn().pipeline()
+        self.__cacheNewRows(pipe, name, rows)
+        # the length of the row cache is the last result queued so far
+        n = len(pipe)
+        res = self.__appendRows(name, ip, rows, pipe)
+        if self.row_cache and res[n - 1] > 2 * self.row_cache:
+            self.__trimRows(name)
+
+    ### ------------------------------------------
+    def __logAppend(self, name, rows):
+        '''Append rows to the append log of list :name. Only the last
+        ctime of the log is checked; the data pages are not read.'''
+        lk = self.__rkey(name + '.log')
+        ck = self.__rkey(name + '.count')
+        with self.__rconn().pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(lk + '::last')
+                    last = pipe.get(lk + '::last')
+                    if last is None:
+                        # the log is empty
+                        last = self.__readIndexPage(name).ctimeMax()
+                    if float(last) >= rows[0][0]:
+                        raise NonFutureItemError()
+                    pipe.multi()
+                    pipe.rpush(lk, *[packLogRow(ctime, content) for (ctime, content) in rows])
+                    pipe.set(lk + '::last', repr(float(rows[-1][0])))
+                    # keep the time the log first had rows
+                    pipe.execute_command('ZADD', self.__rkey('logs'), 'NX', time.time(), name)
+                    pipe.hincrby(ck, 'logged', len(rows))
+                    self.__cacheNewRows(pipe, name, rows)
+                    res = pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        if self.row_cache and res[-1] > 2 * self.row_cache:
+            self.__trimRows(name)
+        n = res[0]
+        if n > self.LOG_MAX:
+            self.__compact(name)
+        else:
+            self.__startFlusher()
+
+    ### ------------------------------------------
+    def __readIndexesAndLogs(self, names):
+        '''For each list in :names, read its index page, and the rows
+        [(ctime, content), ...] in its append log that are not in its
+        data pages yet. Returns a list of (ip, logrows).'''
+        reqs = [(name, ListStoreIndexPage) for name in names]
+        if self.append_log is None:
+            return [(ip, []) for ip in self.__readPages(reqs)]
+        # read the logs before the index pages: rows folded in between
+        # are then found in the index page, and dropped from the log.
+        pipe = self.__rconn().pipeline(transaction=False)
+        for name in names:
+            pipe.lrange(self.__rkey(name + '.log'), 0, -1)
+        logs = pipe.execute()
+        out = []
+        for (ip, entries) in zip(self.__readPages(reqs), logs):
+            last = ip.ctimeMax()
+            out += [(ip, [r for r in map(unpackLogRow, entries) if r[0] > last])]
+        return out
+
+    ### ------------------------------------------
+    def __readIndexAndLog(self, name):
+        return self.__readIndexesAndLogs([name])[0]
+
+    ### ------------------------------------------
+    def __compact(self, name):
+        '''Fold the append log of list :name into its data pages.'''
+        lk = self.__rkey(name + '.log')
+        if not self.__rconn().llen(lk) and not self.__rconn().exists(lk + '::last'):
+            self.__rconn().zrem(self.__rkey('logs'), name)
+            return
+        while not self.__rconn().set(lk + '::lock', 1, nx=True, ex=60):
+            # someone else is folding the log
+            time.sleep(0.05)
+        try:
+            entries = self.__rconn().lrange(lk, 0, -1)
+            ip = self.__readIndexPage(name)
+            last = ip.ctimeMax()
+            rows = [r for r in map(unpackLogRow, entries) if r[0] > last]
+            if rows:
+                # the rows move from the log to the data pages
+                pipe = self.__rconn().pipeline()
+                pipe.hincrby(self.__rkey(name + '.count'), 'logged', -len(rows))
+                self.__appendRows(name, ip, rows, pipe)
+
+            # drop the folded entries
+            with self.__rconn().pipeline() as pipe:
+                while True:
+                    try:
+                        pipe.watch(lk)
+                        n = pipe.llen(lk)
+                        pipe.multi()
+                        pipe.ltrim(lk, len(entries), -1)
+                        if n == len(entries):
+                            pipe.delete(lk + '::last')
+                            pipe.zrem(self.__rkey('logs'), name)
+                        pipe.execute()
+                        break
+                    except redis.WatchError:
+                        continue
+        finally:
+            self.__rconn().delete(lk + '::lock')
+
+    ### ------------------------------------------
+    @stats.operation('compact')
+    def compact(self, name=None, age=0):
+        '''In append-log mode, fold into the data pages the append log
+        of list :name, or if None, the logs that have had rows for at
+        least :age seconds. A separate process may run this
+        periodically in place of the flusher thread. A list that fails
+        to fold is logged and left for the next round, and does not
+        stop the others.'''
+        if name is not None:
+            return self.__compact(name)
+        for name in self.__rconn().zrangebyscore(self.__rkey('logs'), '-inf', time.time() - age):
+            try:
+                self.__compact(name)
+            except Exception:
+                self.metrics.error('compact.error', 'cannot fold the append log of %s', name)
+
+    ### ------------------------------------------
+    @stats.operation('archive')
+    def archive(self, name=None, months=None):
+        '''Merge the segments of each year of list :name whose months
+        are all at least :months (ARCHIVE_MONTHS) months old into
+        yearly segments, as large as a segment may be. If :name is
+        None, archive every list with an index page at the top of the
+        bucket. A separate process may run this periodically. The
+        pages replaced by earlier runs, at least ARCHIVE_GRACE seconds
+        ago, are deleted first.'''
+        if months is None:
+            months = self.ARCHIVE_MONTHS
+        self.__dropArchived(name)
+        if name is not None:
+            return self.__archive(name, months)
+        with self.__s3_bucket_handle() as bkt:
+            names = [key.name[:-3] for key in bkt.list(delimiter='/')
+                     if key.name.endswith('.gz') and '/' not in key.name]
+        for name in names:
+            self.__archive(name, months)
+
+    ### ------------------------------------------
+    def __archive(self, name, months):
+        '''Archive the cold years of list :name. The merged pages are
+        written, then the index page, if it is unchanged meanwhile. The
+        old pages are left to a later run to delete.'''
+        ip = self.__readIndexPage(name)
         g = {}
-        for (ctime, content) in rows:
-            yyyymm = unixTimeToYYYYMM(ctime)
-            g[yyyymm] = g.get(yyyymm, []) + [ (ctime, content) ]
-        for yyyymm in sorted(g.keys()):
-            self.__append(name, yyyymm, g[yyyymm])
+        for k in ip.ymtab.keys():
+            g.setdefault(segmentPeriod(k)[:4], []).append(k)
+        now = time.time()
+        years = [y for (y, ks) in g.items()
+                 if cachepolicy.monthsBetween(y + '12', now) >= months
+                 and len(ks) > 1 and y not in ks]
+        if not years:
+            return
+        old = sorted(k for y in years for k in g[y])
+
+        # copy the rows, with their flags, into segments yyyy, yyyy.001, ...
+        loaded = dict(zip(old, self.__readMonths([(name, k, ip) for k in old])))
+        pages = {}
+        for y in years:
+            seg = None
+            for k in sorted(g[y]):
+                (odp, ofp) = loaded[k]
+                for j in xrange(len(odp)):
+                    content = bytes(odp.blob[odp.offsets[j]:odp.offsets[j+1]])
+                    if seg is None or self.__full(dp, content):
+                        seg = self.__nextSegment(seg) if seg else y
+                        (dp, fp) = (ListStoreDataPage(''), ListStoreFlagPage(''))
+                        pages[seg] = (dp, fp, True)
+                    dp.append(odp.ctimes[j], content)
+                    fp.seen.append(ofp.seen[j])
+                    fp.dismissed.append(ofp.dismissed[j])
+
+        # give up if the list changed meanwhile, or changes before the
+        # index page is written; the next run retries
+        vk = self.__rkey(name + '.gz::ver')
+        with self.__rconn().pipeline() as pipe:
+            try:
+                pipe.watch(vk)
+                fresh = self.__readIndexPage(name)
+                if sorted(k for k in fresh.ymtab if k[:4] in years) != old:
+                    return
+                if any(fresh.ymtab[k] != ip.ymtab[k] for k in old):
+                    return
+                for k in old:
+                    del fresh.ymtab[k]
+                pipe.multi()
+                self.__writeDataPages(name, fresh, pages, pipe)
+            except redis.WatchError:
+                # ours may have reached S3 after the index page written
+                # meanwhile; put that one back
+                self.__writeIndexPage(name, self.__readIndexPage(name))
+                return
+
+        # a writer may still hold the old index page, and write it back
+        # later; the old pages are deleted once it cannot
+        args = []
+        for k in old:
+            args += [time.time(), name + '/' + k + '.gz', time.time(), name + '/' + k + '.flags.gz']
+        self.__rconn().execute_command('ZADD', self.__rkey('archived'), *args)
+
+    ### ------------------------------------------
+    def __dropArchived(self, name=None):
+        '''Delete the pages that archive() replaced at least
+        ARCHIVE_GRACE seconds ago, of list :name or of all lists, but
+        those the index page points to again.'''
+        ak = self.__rkey('archived')
+        keys = self.__rconn().zrangebyscore(ak, '-inf', time.time() - self.ARCHIVE_GRACE)
+        g = {}
+        for k in keys:
+            g.setdefault(k.rpartition('/')[0], []).append(k)
+        if name is not None:
+            g = {name: g.get(name, [])}
+        drop = []
+        for (n, ks) in g.items():
+            if not ks:
+                continue
+            ip = self.__readIndexPage(n)
+            for k in ks:
+                seg = k.rpartition('/')[2][:-len('.gz')]
+                if seg.endswith('.flags'):
+                    seg = seg[:-len('.flags')]
+                if seg not in ip.ymtab:
+                    drop += [k]
+        # pending writes of the pages must not be flushed
+        for k in drop:
+            self.__discard(k)
+        if drop:
+            self.__rconn().zrem(self.__rkey('dirty'), *drop)
+            self.__unlink(rk for k in drop for rk in (self.__rkey(k), self.__rkey(k) + '::ver'))
+            self.__s3purge(drop)
+        ks = [k for n in g for k in g[n]]
+        if ks:
+            self.__rconn().zrem(ak, *ks)
 
     ### ------------------------------------------
+    @stats.operation('delete')
     def delete(self, name, ctime):
         '''Delete the record in list :name identified by :ctime.'''
+        if self.append_log is not None:
+            self.__compact(name)
         ip = self.__readIndexPage(name)
-        yyyymm = unixTimeToYYYYMM(ctime)
-        if ip.ymtab.get(yyyymm):
-            dp = self.__readDataPage(name, yyyymm)
+        seg = ip.segment(ctime)
+        if ip.ymtab.get(seg):
+            (dp, fp) = self.__readMonth(name, seg, ip)
             (i, found) = dp.index(ctime)
             if found:
-                del dp.ctab[i]
-                self.__writeDataPage(name, yyyymm, dp)
+                dp.remove(i)
+                fp.remove(i)
+                self.__writeDataPages(name, ip, {seg: (dp, fp, True)}, self.__dropRows(name, [ctime]))
 
     ### ------------------------------------------
     def __setFlag(self, name, flag, ctime, prior):
+        if self.append_log is not None:
+            self.__compact(name)
         ip = self.__readIndexPage(name)
-        yyyymm = unixTimeToYYYYMM(ctime)
+        dirty = {}
         if not prior:
-            if ip.ymtab.get(yyyymm):
-                dp = self.__readDataPage(name, yyyymm)
-                r = dp.find(ctime)
-                if r and not r[flag]:
-                    r[flag] = 1
-                    self.__writeDataPage(name, yyyymm, dp)
+            seg = ip.segment(ctime)
+            r = ip.ymtab.get(seg)
+            sp = r and ListStoreIndexPage.span(r, flag == 'seen', flag == 'dismissed')
+            if sp and sp[0] <= ctime <= sp[1]:
+                (dp, fp) = self.__readMonth(name, seg, ip)
+                (j, found) = dp.index(ctime)
+                if found:
+                    if not getattr(fp, flag)[j]:
+                        getattr(fp, flag)[j] = 1
+                        dirty[seg] = (dp, fp)
+            if dirty:
+                self.__writeFlagPages(name, ip, dirty, self.__dropRows(name, [ctime]))
             return
 
         # prior is True
+        yyyymm = unixTimeToYYYYMM(ctime)
+        months = []
         for i in ip.ymtab.keys():
-            if i > yyyymm: continue
-            r = ip.ymtab[i]
-            if r['total'] == r[flag]: continue
-            dp = self.__readDataPage(name, i)
+            if segmentPeriod(i) > yyyymm: continue
+            # skip months with no row to flag at or before ctime
+            sp = ListStoreIndexPage.span(ip.ymtab[i], flag == 'seen', flag == 'dismissed')
+            if not sp or sp[0] > ctime: continue
+            months += [i]
+        for (i, (dp, fp)) in zip(months, self.__readMonths([(name, i, ip) for i in months])):
             (j, found) = dp.index(ctime)
             if not found:
                 j = j - 1
-            dirty = 0
-            for j in xrange(j, -1, -1):
-                if not dp.ctab[j][flag]:
-                    dp.ctab[j][flag] = 1
-                    dirty = 1
-            if dirty:
-                self.__writeDataPage(name, i, dp)
+            f = getattr(fp, flag)
+            if f.find(b'\x00', 0, j + 1) >= 0:
+                f[:j+1] = b'\x01' * (j + 1)
+                dirty[i] = (dp, fp)
+        if dirty:
+            self.__writeFlagPages(name, ip, dirty, self.__dropRows(name))
+
+    ### ------------------------------------------
+    @stats.operation('setFlags')
+    def setFlags(self, name, items):
+        '''Set the flags of a batch of records in the list :name.
+        Each item is a (:ctime, :seen, :dismissed) tuple; a true :seen
+        or :dismissed sets that flag of the record identified by
+        :ctime, a false one leaves it alone. Each month touched is read
+        and written once, and the index page is written once. Returns a
+        list telling, for each item, whether its record was found.'''
+        if self.append_log is not None:
+            self.__compact(name)
+        ip = self.__readIndexPage(name)
+        out = [False] * len(items)
+        # group items by segment
+        g = {}
+        for (n, (ctime, seen, dismissed)) in enumerate(items):
+            g.setdefault(ip.segment(ctime), []).append(n)
+        dirty = {}
+        changed = []
+        months = [i for i in sorted(g.keys()) if ip.ymtab.get(i)]
+        for (yyyymm, (dp, fp)) in zip(months, self.__readMonths([(name, i, ip) for i in months])):
+            for n in g[yyyymm]:
+                (ctime, seen, dismissed) = items[n]
+                (j, found) = dp.index(ctime)
+                if not found: continue
+                out[n] = True
+                if seen and not fp.seen[j]:
+                    fp.seen[j] = 1
+                    dirty[yyyymm] = (dp, fp)
+                    changed += [ctime]
+                if dismissed and not fp.dismissed[j]:
+                    fp.dismissed[j] = 1
+                    dirty[yyyymm] = (dp, fp)
+                    changed += [ctime]
+        if dirty:
+            self.__writeFlagPages(name, ip, dirty, self.__dropRows(name, changed))
+        return out
 
     ### ------------------------------------------
+    @stats.operation('setSeen')
     def setSeen(self, name, ctime, prior=False):
         '''Set the seen flag in the list :name for the record
         identified by :ctime. If the prior flag is set, go backwards
@@ -332,6 +1467,7 @@ class ListStore:
         self.__setFlag(name, 'seen', ctime, prior)
 
     ### ------------------------------------------
+    @stats.operation('setDismissed')
     def setDismissed(self, name, ctime, prior=False):
         '''Set the dismissed flag in the list :name for the record
         identified by :ctime. If the prior flag is set, go backwards
@@ -340,62 +1476,324 @@ class ListStore:
         self.__setFlag(name, 'dismissed', ctime, prior)
 
     ### ------------------------------------------
+    @stats.operation('retrieve')
     def retrieve(self, name, ctime):
         '''Retrieve a record identified by :ctime in the list
         :name. If it does not exist, return None.'''
-        ip = self.__readIndexPage(name)
-        yyyymm = unixTimeToYYYYMM(ctime)
-        r = ip.ymtab.get(yyyymm)
-        if r and r['total'] > r['dismissed']:
-            dp = self.__readDataPage(name, yyyymm)
-            r = dp.find(ctime)
-            if r and not r['dismissed']:
-                return r
+        if not self.row_cache:
+            return self.__retrieve(name, ctime)
+        rk = self.__rkey(name + '.rows')
+        (v, gen) = self.__rconn().hmget(rk, repr(float(ctime)), '#gen')
+        if v:
+            self.metrics.record('rowcache.hit')
+            (content, seen, dismissed) = json.loads(v)
+            return {'ctime': float(ctime), 'content': content, 'seen': seen, 'dismissed': dismissed}
+        self.metrics.record('rowcache.miss')
+        row = self.__retrieve(name, ctime)
+        if row:
+            self.__cacheRow(name, row, gen)
+        return row
+
+    ### ------------------------------------------
+    def __retrieve(self, name, ctime):
+        (ip, logrows) = self.__readIndexAndLog(name)
+        for (t, content) in logrows:
+            if t == ctime:
+                return {'ctime': t, 'content': content, 'seen': 0, 'dismissed': 0}
+        seg = ip.segment(ctime)
+        r = ip.ymtab.get(seg)
+        sp = r and ListStoreIndexPage.span(r, 0, 1)
+        if sp and sp[0] <= ctime <= sp[1]:
+            (dp, fp) = self.__readMonth(name, seg, ip)
+            (j, found) = dp.index(ctime)
+            if found:
+                if not fp.dismissed[j]:
+                    return dp.row(j, fp)
         return None
 
     ### ------------------------------------------
-    def reverseScan(self, name, ctime, limit=100, offset=0, skipSeen=0, skipDismissed=1):
-        '''Scan the list :name backwards chronologically starting from
-        :ctime. Read at most :limit records starting at :offset. If
-        skipSeen is set, include only not-seen entries. If
-        skipDismissed is set, include only non-dismissed entries. An
-        array of qualified records will be returned in descending
-        order by :ctime of each record.'''
-        ip = self.__readIndexPage(name)
+    def __cacheRow(self, name, row, gen):
+        '''Cache :row of list :name, read from its pages, in the row
+        cache, unless the rows of the list changed since the cache
+        generation :gen was read, before the pages.'''
+        rk = self.__rkey(name + '.rows')
+        with self.__rconn().pipeline() as pipe:
+            try:
+                pipe.watch(rk)
+                if pipe.hget(rk, '#gen') != gen:
+                    return
+                pipe.multi()
+                pipe.hset(rk, repr(float(row['ctime'])),
+                          json.dumps([row['content'], row['seen'], row['dismissed']]))
+                pipe.expire(rk, self.cache_policy.expiry())
+                pipe.hlen(rk)
+                n = pipe.execute()[-1]
+            except redis.WatchError:
+                return
+        if n > 2 * self.row_cache:
+            self.__trimRows(name)
+
+    ### ------------------------------------------
+    def __cacheNewRows(self, pipe, name, rows):
+        '''Queue on :pipe the caching of :rows [(ctime, content), ...]
+        appended to list :name, and the length of the row cache.'''
+        if not self.row_cache:
+            return
+        rk = self.__rkey(name + '.rows')
+        pipe.hmset(rk, dict((repr(float(ctime)), json.dumps([content, 0, 0]))
+                            for (ctime, content) in rows[-self.row_cache:]))
+        pipe.expire(rk, self.cache_policy.expiry())
+        pipe.hlen(rk)
+
+    ### ------------------------------------------
+    def __dropRows(self, name, ctimes=None):
+        '''Return a pipeline dropping the rows of :ctimes, or all rows,
+        of list :name from the row cache, to be executed with the write
+        of the index page. The cache generation changes, so that rows
+        read before the write are not cached after it.'''
+        pipe = self.__rconn().pipeline()
+        if self.row_cache:
+            rk = self.__rkey(name + '.rows')
+            if ctimes is None:
+                pipe.delete(rk)
+            else:
+                pipe.hdel(rk, *[repr(float(t)) for t in ctimes])
+            pipe.hset(rk, '#gen', uuid.uuid4().hex)
+            pipe.expire(rk, self.cache_policy.expiry())
+        return pipe
+
+    ### ------------------------------------------
+    def __trimRows(self, name):
+        '''Keep the newest row_cache rows of the row cache of list
+        :name.'''
+        rk = self.__rkey(name + '.rows')
+        fields = sorted((f for f in self.__rconn().hkeys(rk) if f != '#gen'), key=float)
+        if len(fields) > self.row_cache:
+            self.__rconn().hdel(rk, *fields[:-self.row_cache])
+
+    ### ------------------------------------------
+    def __iter(self, name, ctime, skipSeen, skipDismissed, offset=0, inclusive=True, limit=None):
+        '''Generate the qualified records of list :name with ctime <=
+        :ctime (< if not :inclusive), newest first, after skipping
+        :offset of them.'''
+        (ip, logrows) = self.__readIndexAndLog(name)
+        for row in self.__iterRows(name, ip, logrows, ctime, skipSeen, skipDismissed,
+                                   offset, inclusive, limit):
+            yield row
+
+    ### ------------------------------------------
+    @staticmethod
+    def __months(ip, ctime, skipSeen, skipDismissed, inclusive):
+        '''Return the segments of :ip that may hold qualified rows
+        with ctime <= :ctime, newest first, as [(segment, (lo, hi)),
+        ...] where lo and hi bound the ctime of those rows.'''
         yyyymm = unixTimeToYYYYMM(ctime)
-        out = []
+        months = []
         for i in sorted(ip.ymtab.keys(), reverse=True):
-            if i > yyyymm: continue
-            if limit <= 0: break
-            ir = ip.ymtab[i]
-            if skipDismissed and ir['total'] == ir['dismissed']:
+            if segmentPeriod(i) > yyyymm: continue
+            sp = ListStoreIndexPage.span(ip.ymtab[i], skipSeen, skipDismissed)
+            if not sp or sp[0] > ctime or (sp[0] == ctime and not inclusive):
+                continue
+            months += [(i, sp)]
+        return months
+
+    ### ------------------------------------------
+    def __iterRows(self, name, ip, logrows, ctime, skipSeen, skipDismissed, offset, inclusive, limit,
+                   loaded=None):
+        '''Generate the qualified records of list :name, given its
+        index page :ip and append log rows :logrows. Months that lie
+        wholly within the offset are skipped using the counts in the
+        index page. Months found in :loaded, a dict {(name, yyyymm):
+        (dp, fp)}, are not read again.
+
+        While records of a month are being consumed, the next month
+        that may hold qualified records is read on the I/O pool,
+        unless this month can provide the :limit records wanted.'''
+        loaded = loaded or {}
+        # rows in the append log are newer than those in the data
+        # pages, and have no flags set
+        for (t, content) in reversed(logrows):
+            if t > ctime or (t == ctime and not inclusive): continue
+            if offset > 0:
+                offset = offset - 1
                 continue
-            if skipSeen and ir['total'] == ir['seen']:
+            if limit is not None:
+                limit = limit - 1
+            yield {'ctime': t, 'content': content, 'seen': 0, 'dismissed': 0}
+
+        months = self.__months(ip, ctime, skipSeen, skipDismissed, inclusive)
+        prefetch = None
+        for (k, (i, (lo, hi))) in enumerate(months):
+            n = ListStoreIndexPage.qualified(ip.ymtab[i], skipSeen, skipDismissed)
+            if (n is not None and offset >= n
+                and (hi < ctime or (hi == ctime and inclusive))):
+                # every qualified row of the month is within the offset
+                offset = offset - n
                 continue
-            dp = self.__readDataPage(name, i)
-            (j, found) = dp.index(ctime)
-            if not found:
-                j = j - 1
+            if (name, i) in loaded:
+                (dp, fp) = loaded[(name, i)]
+            elif prefetch and prefetch[0] == i:
+                (dp, fp) = prefetch[1].result()
+            else:
+                (dp, fp) = self.__readMonth(name, i, ip)
+            prefetch = None
+            if hi < ctime:
+                (j, found) = dp.index(hi)
+                if not found:
+                    j = j - 1
+            else:
+                (j, found) = dp.index(ctime)
+                if not found or not inclusive:
+                    j = j - 1
             for j in xrange(j, -1, -1):
-                if limit <= 0: break
-                jr = dp.ctab[j]
-                if skipDismissed and jr['dismissed']:
+                if dp.ctimes[j] < lo: break
+                if skipDismissed and fp.dismissed[j]:
                     continue
-                if skipSeen and jr['seen']:
+                if skipSeen and fp.seen[j]:
                     continue
                 if offset > 0:
                     offset = offset - 1
                     continue
-                limit = limit - 1
-                out += [jr]
+                if (not prefetch and k + 1 < len(months)
+                    and (name, months[k+1][0]) not in loaded):
+                    # the rest of this month is yielded from here on
+                    if limit is None or self.__qualifiedUpTo(fp, j, skipSeen, skipDismissed) < limit:
+                        prefetch = (months[k+1][0],
+                                    self.io_pool.submit(self.__readMonth, name, months[k+1][0], ip))
+                if limit is not None:
+                    limit = limit - 1
+                yield dp.row(j, fp)
 
+    ### ------------------------------------------
+    def __plan(self, ip, logrows, ctime, limit, offset, skipSeen, skipDismissed):
+        '''Return the months a scan of :limit records at :offset from
+        :ctime is expected to read. Where the index page does not know
+        the qualified count of a month, its total is assumed; a month
+        missed here is read by the scan itself.'''
+        for (t, content) in logrows:
+            if t > ctime: continue
+            if offset > 0:
+                offset = offset - 1
+            else:
+                limit = limit - 1
+        out = []
+        for (i, (lo, hi)) in self.__months(ip, ctime, skipSeen, skipDismissed, True):
+            if limit <= 0: break
+            n = ListStoreIndexPage.qualified(ip.ymtab[i], skipSeen, skipDismissed)
+            if n is not None and offset >= n and hi <= ctime:
+                offset = offset - n
+                continue
+            out += [i]
+            if n is None:
+                n = ip.ymtab[i]['total']
+            m = min(offset, n)
+            offset = offset - m
+            limit = limit - (n - m)
         return out
 
+    ### ------------------------------------------
+    @staticmethod
+    def __qualifiedUpTo(fp, j, skipSeen, skipDismissed):
+        '''Return the number of rows at positions 0..j of fp that pass
+        the skipSeen/skipDismissed filters.'''
+        if skipSeen and skipDismissed:
+            f = fp.either()
+        elif skipSeen:
+            f = fp.seen
+        elif skipDismissed:
+            f = fp.dismissed
+        else:
+            return j + 1
+        return f.count(b'\x00', 0, j + 1)
+
+    ### ------------------------------------------
+    def iterReverse(self, name, ctime, skipSeen=0, skipDismissed=1):
+        '''Like reverseScan, but generate the qualified records one at a
+        time. The next month is read in the background while the
+        records of the current one are consumed.'''
+        return self.__iter(name, ctime, skipSeen, skipDismissed)
 
     ### ------------------------------------------
-    def count(self, name):
-        ip = self.__readIndexPage(name)
-        total, dismissed, seen = 0, 0, 0
+    def __scan(self, name, ctime, limit, offset, skipSeen, skipDismissed, inclusive=True):
+        '''Return :limit qualified records from :offset. The pages the
+        scan is expected to need are read together, as in
+        reverseScanMany. A :ctime of None starts at the newest record.'''
+        if limit <= 0:
+            return []
+        (ip, logrows) = self.__readIndexAndLog(name)
+        if ctime is None:
+            ctime = max([ip.ctimeMax()] + [r[0] for r in logrows[-1:]])
+        months = self.__plan(ip, logrows, ctime, limit, offset, skipSeen, skipDismissed)
+        loaded = {}
+        for (i, m) in zip(months, self.__readMonths([(name, i, ip) for i in months])):
+            loaded[(name, i)] = m
+        it = self.__iterRows(name, ip, logrows, ctime, skipSeen, skipDismissed,
+                             offset, inclusive, limit, loaded)
+        return list(itertools.islice(it, limit))
+
+    ### ------------------------------------------
+    @stats.operation('reverseScan')
+    def reverseScan(self, name, ctime, limit=100, offset=0, skipSeen=0, skipDismissed=1):
+        '''Scan the list :name backwards chronologically starting from
+        :ctime. Read at most :limit records starting at :offset. If
+        skipSeen is set, include only not-seen entries. If
+        skipDismissed is set, include only non-dismissed entries. An
+        array of qualified records will be returned in descending
+        order by :ctime of each record.'''
+        return self.__scan(name, ctime, limit, offset, skipSeen, skipDismissed)
+
+    ### ------------------------------------------
+    @stats.operation('reverseScanPage')
+    def reverseScanPage(self, name, ctime=None, limit=100, skipSeen=0, skipDismissed=1, cursor=None):
+        '''Like reverseScan, but paginated by a cursor instead of an
+        offset, and from the newest record if :ctime is None. Returns
+        (records, cursor). Pass the cursor back, with
+        the same :name, to get the next page; it carries the ctime to
+        resume from and the skipSeen/skipDismissed filters, which
+        override the arguments. The cursor is None after the last
+        page.'''
+        inclusive = True
+        if cursor:
+            try:
+                (ctime, skipSeen, skipDismissed) = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            except (TypeError, ValueError):
+                raise DataError('bad cursor')
+            inclusive = False
+        out = self.__scan(name, ctime, limit, 0, skipSeen, skipDismissed, inclusive)
+        if len(out) < limit:
+            return (out, None)
+        cursor = base64.urlsafe_b64encode(json.dumps([out[-1]['ctime'], skipSeen, skipDismissed]))
+        return (out, cursor)
+
+    ### ------------------------------------------
+    @stats.operation('reverseScanMany')
+    def reverseScanMany(self, names, ctime, limit=100, offset=0, skipSeen=0, skipDismissed=1):
+        '''Like reverseScan, for each list in :names. The index pages
+        of all lists are read together, then the data pages their
+        scans are expected to need, with one MGET for those cached in
+        Redis and concurrent reads from S3 for the rest. Returns a list
+        of record arrays, in the order of :names.'''
+        if limit <= 0:
+            return [[] for name in names]
+        heads = self.__readIndexesAndLogs(names)
+        reqs = []
+        for (name, (ip, logrows)) in zip(names, heads):
+            for i in self.__plan(ip, logrows, ctime, limit, offset, skipSeen, skipDismissed):
+                reqs += [(name, i, ip)]
+        loaded = {}
+        for ((name, i, ip), m) in zip(reqs, self.__readMonths(reqs)):
+            loaded[(name, i)] = m
+        out = []
+        for (name, (ip, logrows)) in zip(names, heads):
+            it = self.__iterRows(name, ip, logrows, ctime, skipSeen, skipDismissed,
+                                 offset, True, limit, loaded)
+            out += [list(itertools.islice(it, limit))]
+        return out
+
+    ### ------------------------------------------
+    @staticmethod
+    def __count(ip, logrows):
+        total, dismissed, seen = len(logrows), 0, 0
         for _, r in ip.ymtab.items():
             total += r['total']
             dismissed += r['dismissed']
@@ -403,26 +1801,163 @@ class ListStore:
 
         return {'total':total, 'dismissed':dismissed, 'seen':seen}
 
+    ### ------------------------------------------
+    def __rebuildCount(self, name):
+        '''Compute the counters of list :name from its index page and
+        append log, and save them unless they changed meanwhile.'''
+        ck = self.__rkey(name + '.count')
+        with self.__rconn().pipeline() as pipe:
+            pipe.watch(ck)
+            (ip, logrows) = self.__readIndexAndLog(name)
+            c = self.__count(ip, [])
+            try:
+                pipe.multi()
+                pipe.hmset(ck, dict(c, logged=len(logrows), built=1))
+                pipe.expire(ck, self.cache_policy.expiry())
+                pipe.execute()
+            except redis.WatchError:
+                pass
+        c['total'] += len(logrows)
+        return c
+
+    ### ------------------------------------------
+    @stats.operation('count')
+    def count(self, name):
+        '''Return the counts {total, seen, dismissed} of list :name.'''
+        return self.countMany([name])[0]
+
+    ### ------------------------------------------
+    @stats.operation('countMany')
+    def countMany(self, names):
+        '''Like count, for each list in :names, in one round trip.
+        Returns a list of counts, in the order of :names.
+
+        The counters of a list are kept in a Redis hash, set whenever
+        its index page is written and bumped when rows go through its
+        append log. A hash that is missing, or was recreated by such an
+        update, is rebuilt from the index page.'''
+        pipe = self.__rconn().pipeline(transaction=False)
+        for name in names:
+            pipe.hmget(self.__rkey(name + '.count'), 'built', 'total', 'seen', 'dismissed', 'logged')
+        out = []
+        for (name, vals) in zip(names, pipe.execute()):
+            if not vals[0]:
+                out += [self.__rebuildCount(name)]
+                continue
+            (total, seen, dismissed, logged) = [int(x or 0) for x in vals[1:]]
+            out += [{'total': total + logged, 'dismissed': dismissed, 'seen': seen}]
+        return out
+
 
     ### ------------------------------------------
+    @stats.operation('deleteName')
     def deleteName(self, name):
         '''Delete the list :name. All known records of the list will
         be deleted.'''
-        bkt = self.__s3_bucket_handle()
-        rs = bkt.list(name)
-        for key in rs:
-            bkt.delete_key(key)
-            self.__rconn().delete(key.name)
+        if self.write_behind is not None:
+            # pending writes of the list must not be flushed
+            dk = self.__rkey('dirty')
+            self.__rconn().zrem(dk, name + '.gz')
+            self.__zpurge(dk, globEscape(name + '/') + '*')
+        self.__zpurge(self.__rkey('archived'), globEscape(name + '/') + '*')
+        if self.append_log is not None:
+            lk = self.__rkey(name + '.log')
+            self.__rconn().delete(lk, lk + '::last')
+            self.__rconn().zrem(self.__rkey('logs'), name)
+        # name + '/' and not name, which would match other lists too
+        with self.__s3_bucket_handle() as bkt:
+            keys = itertools.chain([name + '.gz'], (key.name for key in bkt.list(name + '/')))
+            self.__s3purge(keys)
         self.clearCache(name)
 
+    ### ------------------------------------------
+    @stats.operation('purge')
+    def purge(self, prefix):
+        '''Delete every list whose name starts with :prefix, e.g. all
+        the lists of a tenant, from S3 and Redis. Pending writes and
+        append logs of the lists are dropped.'''
+        match = globEscape(prefix) + '*'
+        self.__zpurge(self.__rkey('dirty'), match)
+        self.__zpurge(self.__rkey('logs'), match)
+        self.__zpurge(self.__rkey('archived'), match)
+        with self.__s3_bucket_handle() as bkt:
+            self.__s3purge(key.name for key in bkt.list(prefix))
+        shared = [self.__rkey(k) for k in ('dirty', 'logs', 'mem', 'archived')]
+        self.__rpurge(globEscape(self.__rkey(prefix)) + '*', shared)
 
     ### ------------------------------------------
-    def clearCache(self, name):
-        '''Drop all Redis cache of the records belonging to the :name list.'''
-        k = name + '.gz'
-        self.__rconn().delete('liststore::%s::%s' % (self.s3_bucket_name, k))
-        k = name + '/*.gz'
-        keys = self.__rconn().keys('liststore::%s::%s' % (self.s3_bucket_name, k))
-        for k in keys:
-            self.__rconn().delete(k)
+    def __s3purge(self, keys):
+        '''Delete the S3 :keys, an iterable of key names, with one
+        multi-object delete per PURGE_BATCH keys. Keys not in S3 are
+        ignored.'''
+        for batch in self.__batches(keys):
+            with self.__s3_bucket_handle() as bkt:
+                with self.metrics.timer('s3.delete'):
+                    r = bkt.delete_keys(batch, quiet=True)
+            if r.errors:
+                e = r.errors[0]
+                raise Error('cannot delete %s from S3: %s %s' % (e.key, e.code, e.message))
+
+    ### ------------------------------------------
+    def __rpurge(self, match, keep=()):
+        '''Delete the Redis keys matching glob :match, but those in
+        :keep. Keys are found by SCAN and deleted by UNLINK,
+        PURGE_BATCH at a time, so that Redis is never blocked for
+        long.'''
+        rks = self.__rconn().scan_iter(match=match, count=self.PURGE_BATCH)
+        self.__unlink(rk for rk in rks if rk not in keep)
+
+    ### ------------------------------------------
+    def __unlink(self, rks):
+        '''Delete the Redis keys rks, an iterable, with one UNLINK per
+        PURGE_BATCH keys. UNLINK frees their memory in the
+        background.'''
+        for batch in self.__batches(rks):
+            with self.metrics.timer('redis.unlink'):
+                self.__rconn().unlink(*batch)
+
+    ### ------------------------------------------
+    def __zpurge(self, zk, match):
+        '''Remove the members matching glob :match from the Redis
+        sorted set zk.'''
+        members = (m for (m, score) in self.__rconn().zscan_iter(zk, match=match, count=self.PURGE_BATCH))
+        for batch in self.__batches(members):
+            self.__rconn().zrem(zk, *batch)
 
+    ### ------------------------------------------
+    def __batches(self, items):
+        '''Yield the iterable :items in lists of PURGE_BATCH.'''
+        batch = []
+        for x in items:
+            batch += [x]
+            if len(batch) == self.PURGE_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+    ### ------------------------------------------
+    def statsSnapshot(self):
+        '''Return a snapshot of the metrics of this store; see
+        stats.Metrics.snapshot.'''
+        return self.metrics.snapshot()
+
+    ### ------------------------------------------
+    def cacheUsage(self):
+        '''Measure the Redis memory used by this bucket, and record it
+        for the max_memory of the cache policy. Returns {keys, bytes,
+        time}. It scans the keys of the bucket; run it periodically,
+        from one process.'''
+        return self.cache_policy.measure(self.__rconn(), self.__rkey(''))
+
+    ### ------------------------------------------
+    @stats.operation('clearCache')
+    def clearCache(self, name):
+        '''Drop all Redis cache of the records belonging to the :name
+        list. In write-behind mode, its dirty pages are flushed first.'''
+        if self.write_behind is not None:
+            self.flush(name)
+        rk = self.__rkey(name)
+        self.__unlink([rk + '.gz', rk + '.gz::ver', rk + '.count', rk + '.rows'])
+        self.__rpurge(globEscape(rk + '/') + '*')
@@ -0,0 +1,224 @@
+'''Operation metrics of the stores: counters, latency histograms,
+callback hooks and per-call traces.'''
+import time, threading, collections, contextlib, logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# upper bounds, in seconds, of the latency histogram buckets: 0.1ms
+# doubling up to about 52s, and one more for anything longer
+BOUNDS = [0.0001 * 2 ** i for i in xrange(20)]
+
+# the operation and trace of the calling thread, shared by all
+# Metrics so that a trace covers every store used in a call
+_local = threading.local()
+
+### ------------------------------------------
+class Histogram:
+    '''Latencies in buckets of exponentially growing bounds.'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, secs):
+        i = 0
+        while i < len(BOUNDS) and secs > BOUNDS[i]:
+            i = i + 1
+        self.counts[i] += 1
+        self.n += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def percentile(self, p):
+        '''Return the upper bound of the bucket holding the :p'th
+        percentile, or the max if it is in the last bucket.'''
+        want = self.n * p / 100.0
+        seen = 0
+        for (i, c) in enumerate(self.counts):
+            seen += c
+            if seen >= want and c:
+                return BOUNDS[i] if i < len(BOUNDS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        return {'count': self.n, 'total': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+### ------------------------------------------
+class Trace:
+    '''The events recorded while tracing one call, in the calling
+    thread and in the I/O threads working for it: a list of (name,
+    seconds, nbytes), where seconds is None for a plain count.'''
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.seconds = None
+
+    def add(self, name, seconds, nbytes):
+        with self.lock:
+            self.events.append((name, seconds, nbytes))
+
+    def summary(self):
+        '''Return {name: {count, seconds, bytes}}.'''
+        out = {}
+        with self.lock:
+            for (name, seconds, nbytes) in self.events:
+                e = out.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                e['count'] += 1
+                e['seconds'] += seconds or 0.0
+                e['bytes'] += nbytes
+        return out
+
+
+### ------------------------------------------
+class Metrics:
+    '''Counters and latency histograms of the operations of one or
+    more stores.
+
+    Counters are kept by event name, e.g. 's3.get', and also by
+    operation and event name, e.g. 'reverseScan:s3.get', for events
+    within a public call. Events with a size add it to the counter
+    name + '.bytes'. Timed events also go into a histogram by name;
+    each public call is timed as 'op.' + its name.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+        self.hooks = []
+
+    def addHook(self, fn):
+        '''Call fn(name, seconds, nbytes, op) on every event. It is
+        called on the thread doing the I/O, so it must be quick. An
+        error of fn is logged, and does not fail the I/O.'''
+        self.hooks = self.hooks + [fn]
+
+    def removeHook(self, fn):
+        self.hooks = [h for h in self.hooks if h != fn]
+
+    def record(self, name, seconds=None, nbytes=0, n=1):
+        '''Record :n events :name, that took :seconds (if timed) and
+        moved :nbytes.'''
+        op = getattr(_local, 'op', None)
+        with self.lock:
+            self.counters[name] += n
+            if nbytes:
+                self.counters[name + '.bytes'] += nbytes
+            if op:
+                self.counters[op + ':' + name] += n
+                if nbytes:
+                    self.counters[op + ':' + name + '.bytes'] += nbytes
+            if seconds is not None:
+                h = self.histograms.get(name)
+                if not h:
+                    h = self.histograms[name] = Histogram()
+                h.add(seconds)
+        trace = getattr(_local, 'trace', None)
+        if trace:
+            trace.add(name, seconds, nbytes)
+        for fn in self.hooks:
+            try:
+                fn(name, seconds, nbytes, op)
+            except Exception:
+                log.exception('metrics hook %r failed on %s', fn, name)
+
+    def error(self, name, msg, *args):
+        '''Log the exception being handled with :msg % :args, and count
+        it as event :name.'''
+        log.exception(msg, *args)
+        self.record(name)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''Time the body as event :name. The body may set the nbytes
+        attribute of the object yielded.'''
+        t = Timer()
+        start = time.time()
+        try:
+            yield t
+        finally:
+            self.record(name, time.time() - start, t.nbytes)
+
+    @contextlib.contextmanager
+    def op(self, name):
+        '''Time the body as the public call :name. A call made within
+        another is not timed, and its events are counted for the outer
+        one.'''
+        outer = getattr(_local, 'op', None)
+        _local.op = outer or name
+        start = time.time()
+        try:
+            yield
+        finally:
+            _local.op = outer
+            if not outer:
+                self.record('op.' + name, time.time() - start)
+
+    def snapshot(self):
+        '''Return {counters: {name: n}, latency: {name: {count, total,
+        max, p50, p90, p99}}}, in seconds.'''
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'latency': dict((k, h.snapshot()) for (k, h) in self.histograms.items())}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+### ------------------------------------------
+class Timer:
+    def __init__(self):
+        self.nbytes = 0
+
+
+### ------------------------------------------
+@contextlib.contextmanager
+def trace():
+    '''Trace the events of the body, in this thread and in the I/O
+    threads working for it. Yields the Trace.'''
+    outer = getattr(_local, 'trace', None)
+    t = _local.trace = Trace()
+    try:
+        yield t
+    finally:
+        t.seconds = time.time() - t.start
+        _local.trace = outer
+
+### ------------------------------------------
+def context():
+    '''Return the operation and trace of this thread, to hand to
+    another thread doing work for it.'''
+    return (getattr(_local, 'op', None), getattr(_local, 'trace', None))
+
+### ------------------------------------------
+@contextlib.contextmanager
+def restored(ctx):
+    '''Run the body under the operation and trace :ctx, as returned by
+    context() in another thread.'''
+    saved = context()
+    (_local.op, _local.trace) = ctx
+    try:
+        yield
+    finally:
+        (_local.op, _local.trace) = saved
+
+### ------------------------------------------
+def operation(name):
+    '''Decorate a method of a store, with a metrics attribute, to be
+    timed and counted as the public call :name.'''
+    def wrap(fn):
+        def call(self, *args, **kw):
+            with self.metrics.op(name):
+                return fn(self, *args, **kw)
+        call.__name__ = fn.__name__
+        call.__doc__ = fn.__doc__
+        return call
+    return wrap
@@ -0,0 +1,20 @@
+import time
+import cachepolicy
+
+
+def test_cachepolicy():
+    p = cachepolicy.CachePolicy(ttl=100, old_ttl=10, hot_months=1, max_object=1000)
+    tm = time.gmtime()
+    this = '%04d%02d' % (tm.tm_year, tm.tm_mon)
+    assert p.expiry() == 100, 'Wrong ttl'
+    assert p.expiry(this) == 100, 'Wrong ttl of this month'
+    assert p.expiry('201301') == 10, 'Wrong ttl of an old month'
+    assert cachepolicy.monthsBetween('201311', time.mktime((2014, 2, 1, 0, 0, 0, 0, 0, 0))) == 3, \
+        'Wrong month difference'
+
+    assert p.fits(1000) and not p.fits(1001), 'Wrong object size limit'
+    assert cachepolicy.CachePolicy().fits(1 << 30), 'Default has an object size limit'
+
+    # without old_ttl, all pages get ttl
+    p = cachepolicy.CachePolicy(ttl=100)
+    assert p.expiry('201301') == 100, 'Wrong ttl of an old month'
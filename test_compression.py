@@ -0,0 +1,32 @@
+import compression
+
+
+def test_compression():
+    s = ''.join(chr(i % 7 + 97) for i in xrange(5000))
+    for spec in sorted(compression.CODECS.keys()) + ['gzip:1', 'zlib:9', 'bz2:1']:
+        z = compression.compress(s, spec)
+        assert compression.uncompress(z) == s, 'Round trip failed for %s' % spec
+        assert compression.codecOf(z) == spec.partition(':')[0], 'Wrong codec for %s' % spec
+
+    # gzip is written without a header, as before codecs existed
+    z = compression.compress(s)
+    assert z[:2] == '\x1f\x8b', 'gzip object has a header'
+
+    # recode keeps an object already in the codec, at any level
+    z = compression.compress(s, 'zlib:1')
+    assert compression.recode(z, 'zlib:9') is z, 'Object recoded needlessly'
+    assert compression.codecOf(compression.recode(z, 'none')) == 'none', 'Object not recoded'
+
+    for bad in ('snappy', 'zlib:fast'):
+        try:
+            compression.compress(s, bad)
+        except compression.Error:
+            continue
+        assert False, 'Bad codec %s accepted' % bad
+
+    try:
+        compression.uncompress('CZ\x01\xff')
+    except compression.DataError:
+        pass
+    else:
+        assert False, 'Unknown codec id accepted'
@@ -0,0 +1,65 @@
+import threading, time
+import boto.exception
+import connpool
+
+
+class Conn:
+    def __init__(self, opened):
+        opened.append(self)
+        self.closed = False
+
+    def get_bucket(self, name):
+        return (self, name)
+
+    def close(self):
+        self.closed = True
+
+
+def test_connpool():
+    opened = []
+    pool = connpool.S3Pool('x', 'y', size=2, connect=lambda a, b: Conn(opened))
+
+    # connections are reused, and nested uses share one
+    with pool.bucket('b') as (c, name):
+        with pool.bucket('b') as (c2, name2):
+            assert c2 is c, 'Nested use took another connection'
+    with pool.bucket('b') as (c3, name3):
+        assert c3 is c, 'Connection not reused'
+    assert len(opened) == 1, 'Wrong connections %s' % opened
+
+    # at most size connections; a third thread waits
+    held = threading.Event()
+    release = threading.Event()
+    def hold():
+        with pool.bucket('b'):
+            held.set()
+            release.wait()
+    threads = [threading.Thread(target=hold) for i in range(3)]
+    for th in threads:
+        th.start()
+    held.wait()
+    time.sleep(0.1)
+    assert len(opened) == 2, 'Pool size exceeded: %s' % opened
+    release.set()
+    for th in threads:
+        th.join()
+
+    # an error response keeps the connection; another error closes it
+    try:
+        with pool.bucket('b') as (c, name):
+            raise boto.exception.S3ResponseError(404, 'Not Found')
+    except boto.exception.S3ResponseError:
+        pass
+    assert not c.closed, 'Connection closed on an error response'
+    try:
+        with pool.bucket('b') as (c, name):
+            raise IOError('reset')
+    except IOError:
+        pass
+    assert c.closed, 'Failed connection not closed'
+
+    # a forked process opens its own connections
+    pool.pid = -1
+    with pool.bucket('b') as (c, name):
+        assert c is opened[-1] and len(opened) == 3, 'Connection of the parent reused'
+
@@ -1,7 +1,7 @@
 import unittest
 import calendar
-import os, sys, time
-import docstore
+import os, sys, time, threading
+import docstore, asyncstore
 
 class Conf:
     bucketname = None
@@ -62,3 +62,73 @@ def test_docstore():
         assert s == 'this is ' + str(i), 'Content mismatch'
 
 
+
+    # rewrite the odd entries with another codec, cached uncompressed
+    ds = docstore.DocStore(Conf.bucketname,
+                           Conf.aws_access_key, Conf.aws_secret_key,
+                           Conf.redis_host, Conf.redis_port,
+                           codec='zlib:1', cache_codec='none')
+    for i in xrange(1, 27, 2):
+        ds.put(path, str(i), 'this is also ' + str(i))
+    for i in xrange(0, 27, 3):
+        ds._deleteFromCache(path, str(i))
+
+    # both codecs are read back, from redis and from s3
+    for i in xrange(27):
+        s = ds.get(path, str(i))
+        expect = ('this is also ' if i % 2 else 'this is ') + str(i)
+        assert s == expect, 'Content mismatch'
+
+    # a deleted entry is not found, until it is put again
+    ds.delete(path, '0')
+    assert ds.get(path, '0') == None, 'Deleted entry found'
+    ds.put(path, '0', 'this is 0')
+    assert ds.get(path, '0') == 'this is 0', 'Content mismatch'
+
+    # batches: put, then get from redis and s3, in the order asked
+    ds.putMany(path, dict((str(i), 'batch ' + str(i)) for i in xrange(10)))
+    for i in xrange(0, 10, 2):
+        ds._deleteFromCache(path, str(i))
+    # 30 and 31 were never put
+    ids = [str(i) for i in range(10) + [30, 31]][::-1]
+    expect = [None, None] + ['batch ' + str(i) for i in xrange(10)][::-1]
+    assert ds.getMany(path, ids) == expect, 'Wrong batch get'
+    assert ds.getMany(path, ids) == expect, 'Wrong batch get from redis'
+    c = ds.statsSnapshot()['counters']
+    assert c['getMany:s3.get'] == 7 and c['getMany:redis.mget'] == 2, 'Wrong batch reads %s' % c
+    assert ds.getMany(path, []) == [], 'Wrong empty batch get'
+
+    # listing in pages, and by sub-path, cached in redis
+    ds = docstore.DocStore(Conf.bucketname,
+                           Conf.aws_access_key, Conf.aws_secret_key,
+                           Conf.redis_host, Conf.redis_port,
+                           list_cache=60)
+    ds.put(path + '/sub', 'a', 'in a sub-path')
+    ids = ds.list(path, 1000)
+    assert 'sub/a' in ids and len(ids) == 28, 'Wrong list %s' % ids
+    (pages, marker) = ds.listPage(path, 10)
+    while marker:
+        (more, marker) = ds.listPage(path, 10, marker)
+        pages += more
+    assert pages == ids, 'Wrong pages %s' % pages
+    page = ds.listPage(path, 1000, delimiter='/')
+    assert 'sub/' in page[0] and 'sub/a' not in page[0] and page[1] is None, 'Wrong sub-path listing %s' % (page,)
+    assert ds.listPage(path, 1000, delimiter='/') == page, 'Wrong cached listing'
+    assert ds.statsSnapshot()['counters']['listcache.hit'] == 1, 'Listing not cached'
+    ds.delete(path, '1')
+    assert '1' not in ds.listPage(path, 1000, delimiter='/')[0], 'Listing not dropped by delete'
+    assert 'sub/b' not in ds.list(path, 1000), 'Wrong list'
+    ds.put(path + '/sub', 'b', 'in a sub-path')
+    assert 'sub/b' in ds.list(path, 1000), 'Listing not dropped by put'
+    ds.put(path, '1', 'this is 1')
+
+    # the same calls, in the background
+    ads = asyncstore.AsyncDocStore(ds, threads=4)
+    fs = [ads.get(path, str(i)) for i in xrange(27)]
+    called = threading.Event()
+    fs[-1].add_done_callback(lambda f: f.result() and called.set())
+    assert [f.result() for f in fs] == [ds.get(path, str(i)) for i in xrange(27)], 'Wrong background gets'
+    assert called.wait(10), 'Callback not called'
+    ads.delete(path, '0').result()
+    assert ads.get(path, '0').result() == None, 'Deleted entry found'
+    assert ads.list(path, 1000).result() == ds.list(path, 1000), 'Wrong background list'
@@ -1,6 +1,6 @@
 import calendar
-import os, sys, time
-import liststore
+import os, sys, time, json, threading
+import liststore, cachepolicy, stats, asyncstore, redis
 
 class Conf:
     bucketname = None
@@ -116,6 +116,41 @@ def test_liststore():
             t = t - 24 * 60 * 60
 
 
+    def doPagedScan():
+        for (skipSeen, skipDismissed) in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            full = ls.reverseScan(name, aug23, limit=400, skipSeen=skipSeen, skipDismissed=skipDismissed)
+            out = ls.reverseScan(name, aug23, limit=10, offset=100, skipSeen=skipSeen, skipDismissed=skipDismissed)
+            assert out == full[100:110], 'Wrong records at offset 100'
+
+            out, cursor = ls.reverseScanPage(name, aug23, limit=50, skipSeen=skipSeen, skipDismissed=skipDismissed)
+            while cursor:
+                rows, cursor = ls.reverseScanPage(name, limit=50, cursor=cursor)
+                out += rows
+            assert out == full, 'Paged scan differs from full scan'
+
+            # without a ctime, from the newest record
+            newest = ls.reverseScan(name, start + 400 * (24 * 60 * 60), limit=50,
+                                    skipSeen=skipSeen, skipDismissed=skipDismissed)
+            out, cursor = ls.reverseScanPage(name, limit=50, skipSeen=skipSeen, skipDismissed=skipDismissed)
+            assert out == newest and (cursor or len(out) < 50), 'Wrong first page without a ctime'
+
+            out = list(ls.iterReverse(name, aug23, skipSeen=skipSeen, skipDismissed=skipDismissed))
+            assert out == full, 'Streamed scan differs from full scan'
+
+
+    def doScanMany():
+        names = [name, name + '-none', name]
+        for (skipSeen, skipDismissed) in ((0, 0), (1, 1)):
+            outs = ls.reverseScanMany(names, aug23, limit=40, offset=30,
+                                      skipSeen=skipSeen, skipDismissed=skipDismissed)
+            for (n, out) in zip(names, outs):
+                one = ls.reverseScan(n, aug23, limit=40, offset=30,
+                                     skipSeen=skipSeen, skipDismissed=skipDismissed)
+                assert out == one, 'Multi-list scan differs from scan of %s' % n
+        counts = ls.countMany(names)
+        assert counts == [ls.count(n) for n in names], 'Wrong counts %s' % counts
+
+
     # print 'test insert'
     doInsert()
 
@@ -138,6 +173,7 @@ def test_liststore():
 
     # print 'test reverse scan'
     doReverseScan()
+    doPagedScan()
 
     # print 'clear cache and test again'
     ls.clearCache(name)
@@ -145,3 +181,343 @@ def test_liststore():
     # print 'test reverse scan again'
     doReverseScan()
 
+
+    # print 'repeat with an in-process page cache'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             page_cache=liststore.PageCache())
+    ls.deleteName(name)
+    doInsert()
+    doDismiss()
+    doSetSeen()
+    verifySeenAndDismissed()
+    verifySeenAndDismissed()
+    doReverseScan()
+    ls.clearCache(name)
+    doReverseScan()
+
+    # print 'set flags in a batch'
+    jun2 = jun1 + 24 * 60 * 60
+    found = ls.setFlags(name, [(aug23, 1, 0), (aug23 + 1, 1, 0), (jun2, 1, 1)])
+    assert found == [True, False, True], 'Wrong setFlags result %s' % found
+    r = ls.retrieve(name, aug23)
+    assert (r and r['seen']), 'Seen record is not seen'
+    r = ls.retrieve(name, jun2)
+    assert r == None, 'Dismissed record is not dismissed'
+    c = ls.count(name)
+    assert c['seen'] == 76, 'Wrong seen count %d' % c['seen']
+    assert c['dismissed'] == 47, 'Wrong dismissed count %d' % c['dismissed']
+
+    # print 'scan and count several lists at once'
+    doScanMany()
+
+    # print 'trace the I/O of a scan'
+    ls.clearCache(name)
+    with stats.trace() as tr:
+        ls.reverseScan(name, aug23, limit=300)
+    io = tr.summary()
+    assert io['redis.miss']['count'] and io['s3.get']['bytes'] > 0, 'Wrong trace %s' % io
+    c = ls.statsSnapshot()['counters']
+    assert c['op.reverseScan'] > 0 and c['reverseScan:s3.get'] > 0, 'Wrong counters %s' % c
+
+    # print 'repeat with months split into segments of 20 rows'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             io_threads=16)
+    ls.SEGMENT_ROWS = 20
+    ls.deleteName(name)
+    doInsert()
+    doDismiss()
+    doSetSeen()
+    verifySeenAndDismissed()
+    doReverseScan()
+    doPagedScan()
+    doScanMany()
+
+    # print 'append to an emptied last segment, before where it started'
+    ls.deleteName(name)
+    ls.SEGMENT_ROWS = 2
+    days = [start + i * (24 * 60 * 60) for i in xrange(5)]
+    ls.append(name, [(t, 'day') for t in days])
+    ls.delete(name, days[4])
+    t = days[3] + 12 * 60 * 60
+    ls.append(name, [(t, 'half a day later')])
+    assert ls.retrieve(name, t)['content'] == 'half a day later', 'Appended row not found'
+    ls.setSeen(name, t)
+    assert ls.retrieve(name, t)['seen'] == 1, 'Appended row not flagged'
+    ls.delete(name, t)
+    assert ls.retrieve(name, t) == None, 'Appended row not deleted'
+    assert [r['ctime'] for r in ls.reverseScan(name, t)] == days[3::-1], 'Wrong rows after delete'
+    ls.SEGMENT_ROWS = 20
+
+    # print 'archive 2013 into yearly segments, then change it'
+    ls.deleteName(name)
+    doInsert()
+    rconn = redis.StrictRedis(Conf.redis_host, Conf.redis_port)
+    ik = 'liststore::%s::%s.gz' % (Conf.bucketname, name)
+    stale = rconn.get(ik)
+    ls.archive(name)
+    # a writer holding the index page read before the archive writes
+    # it back; the monthly pages are kept for it
+    rconn.set(ik, stale)
+    rconn.set(ik + '::ver', 'stale')
+    assert len(ls.reverseScan(name, aug23, limit=400)) == 235, 'Rows lost by archive'
+    ls.ARCHIVE_GRACE = 0
+    ls.archive(name)
+    assert rconn.exists(ik.replace('.gz', '/201301.gz')), 'Pages in use deleted'
+    ls.archive(name)
+    assert not rconn.exists(ik.replace('.gz', '/201301.gz')), 'Old pages not deleted'
+    assert len(ls.reverseScan(name, aug23, limit=400)) == 235, 'Rows lost by archive'
+    del ls.ARCHIVE_GRACE
+    doDismiss()
+    doSetSeen()
+    verifySeenAndDismissed()
+    doReverseScan()
+    doPagedScan()
+    ls.clearCache(name)
+    verifySeenAndDismissed()
+
+    # print 'repeat with a row cache'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             row_cache=50)
+    ls.deleteName(name)
+    doInsert()
+    assert rconn.hlen('liststore::%s::%s.rows' % (Conf.bucketname, name)) <= 100, 'Row cache not trimmed'
+    doDismiss()
+    doSetSeen()
+    verifySeenAndDismissed()
+    verifySeenAndDismissed()
+    c = ls.statsSnapshot()['counters']
+    assert c['rowcache.hit'] > 0, 'No record served from the row cache'
+    ls.delete(name, aug23)
+    assert ls.retrieve(name, aug23) == None, 'Deleted record still cached'
+
+    # print 'repeat in write-behind mode'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             write_behind=1)
+    ls.deleteName(name)
+    doInsert()
+    doDismiss()
+    doSetSeen()
+    verifySeenAndDismissed()
+    ls.close()
+    # print 'verify what was flushed to s3'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port)
+    ls.clearCache(name)
+    verifySeenAndDismissed()
+    doReverseScan()
+
+    # print 'a failed round of the flusher is counted'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             write_behind=0)
+    def fail(name=None, age=0):
+        raise IOError('S3 is down')
+    ls.flush = fail
+    ls.append(name + '-flush', [(start, 'x')])
+    for i in xrange(50):
+        if ls.statsSnapshot()['counters'].get('flush.error'):
+            break
+        time.sleep(0.1)
+    assert ls.statsSnapshot()['counters'].get('flush.error'), 'Failed flush not counted'
+    del ls.flush
+    ls.deleteName(name + '-flush')
+    ls.close()
+
+    # print 'repeat with another codec, cached uncompressed in redis'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             codec='deflate', cache_codec='none')
+    verifySeenAndDismissed()
+    doDismiss()
+    ls.clearCache(name)
+    verifySeenAndDismissed()
+    ls.deleteName(name)
+    doInsert()
+    doDismiss()
+    doSetSeen()
+    # print 'read the pages with the default codec'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port)
+    verifySeenAndDismissed()
+    ls.clearCache(name)
+    verifySeenAndDismissed()
+    doReverseScan()
+
+    # print 'cache pages read from s3 on their second miss only'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             cache_policy=cachepolicy.CachePolicy(admit_after=2, old_ttl=60))
+    rconn = redis.StrictRedis(Conf.redis_host, Conf.redis_port)
+    rk = 'liststore::%s::%s.gz' % (Conf.bucketname, name)
+    ls.clearCache(name)
+    ls.retrieve(name, aug23)
+    assert not rconn.exists(rk), 'Index page cached on first miss'
+    ls.retrieve(name, aug23)
+    assert rconn.exists(rk), 'Index page not cached on second miss'
+    verifySeenAndDismissed()
+    ls.clearCache(name)
+    doReverseScan()
+    doReverseScan()
+    assert 0 < rconn.ttl(rk.replace('.gz', '/201303.gz')) <= 60, 'Old page cached too long'
+    u = ls.cacheUsage()
+    assert u['keys'] > 0 and u['bytes'] > 0, 'Wrong cache usage %s' % u
+
+    # print 'repeat in append-log mode'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             append_log=60)
+    ls.deleteName(name)
+    doInsert()
+    out = ls.reverseScan(name, aug23, limit=300)
+    assert len(out) == 235, 'Appended rows are not all visible'
+    c = ls.count(name)
+    assert c['total'] == 365, 'Wrong total count %d' % c['total']
+    ls.compact(name)
+    assert ls.count(name) == c, 'Count changed by compaction'
+    doDismiss()
+    doSetSeen()
+    verifySeenAndDismissed()
+    doReverseScan()
+    doScanMany()
+
+    # content that is not utf-8 is refused before it reaches the log
+    c = ls.count(name)
+    try:
+        ls.append(name, [(aug23 + 86400 * 400, 'good'), (aug23 + 86400 * 401, b'\xff\xfe')])
+    except liststore.DataError:
+        pass
+    else:
+        assert False, 'Bad content appended'
+    assert ls.count(name) == c, 'Rows of a bad batch appended'
+
+    # a log that cannot be folded does not stop the others
+    bad, other = name + '-bad', name + '-other'
+    ls.deleteName(other)
+    ls.append(other, [(start, 'other')])
+    rconn.rpush('liststore::%s::%s.log' % (Conf.bucketname, bad), liststore.packLogRow(start, b'\xff'))
+    rconn.zadd('liststore::%s::logs' % Conf.bucketname, {bad: 0})
+    ls.compact()
+    assert not rconn.llen('liststore::%s::%s.log' % (Conf.bucketname, other)), 'Other log not folded'
+    assert ls.statsSnapshot()['counters']['compact.error'] == 1, 'Failed fold not counted'
+    ls.deleteName(bad)
+    ls.deleteName(other)
+
+    # print 'the same calls, in the background'
+    als = asyncstore.AsyncListStore(ls, threads=8)
+    days = [start + i * (24 * 60 * 60) for i in xrange(0, 365, 7)]
+    fs = [als.retrieve(name, t) for t in days]
+    assert [f.result() for f in fs] == [ls.retrieve(name, t) for t in days], 'Wrong background retrieves'
+    out = als.reverseScan(name, aug23, limit=50).result()
+    assert out == ls.reverseScan(name, aug23, limit=50), 'Wrong background scan'
+    als.setSeen(name, aug23).result()
+    assert ls.retrieve(name, aug23)['seen'] == 1, 'Background setSeen not done'
+    later = start + 400 * (24 * 60 * 60)
+    als.append(name, [(later, 'later')]).result()
+    assert als.count(name).result() == ls.count(name), 'Wrong background count'
+    assert ls.retrieve(name, later)['content'] == 'later', 'Background append not done'
+    f = als.append(name, [(start, 'too early')])
+    assert isinstance(f.exception(), liststore.NonFutureItemError), 'Background error not raised'
+
+    # print 'share a store and its page cache across threads'
+    ls = liststore.ListStore(Conf.bucketname,
+                             Conf.aws_access_key, Conf.aws_secret_key,
+                             Conf.redis_host, Conf.redis_port,
+                             page_cache=liststore.PageCache())
+    shared = name + '-threads'
+    ls.deleteName(shared)
+    hours = [start + i * (7 * 60 * 60) for i in xrange(200)]
+    done = threading.Event()
+    errors = []
+    def work(fn):
+        def run():
+            try:
+                fn()
+            except Exception as e:
+                errors.append(e)
+            done.set()
+        return threading.Thread(target=run)
+    def append():
+        for t in hours:
+            if done.is_set(): break
+            ls.append(shared, [(t, 'at %d' % t)])
+    def scan():
+        while not done.is_set():
+            ls.reverseScan(shared, hours[-1], limit=50)
+            list(ls.iterReverse(shared, hours[-1]))
+    def flag():
+        i = 0
+        while not done.is_set():
+            ls.setSeen(shared, hours[i % 100])
+            ls.setFlags(shared, [(hours[(i * 7) % 100], 1, i % 2)])
+            i = i + 1
+    threads = [work(fn) for fn in (append, scan, scan, scan, flag)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert not errors, 'Error in a thread sharing the store: %r' % errors
+    out = [r['ctime'] for r in ls.reverseScan(shared, hours[-1], limit=300, skipDismissed=0)]
+    assert out and out == sorted(set(out), reverse=True), 'Bad scan after the threads'
+    ls.deleteName(shared)
+
+    # print 'delete lists in bulk'
+    other = name + '-2'
+    ls.append(other, [(jun1, 'x')])
+    ls.deleteName(name)
+    assert ls.count(other)['total'] == 1, 'Other list deleted by deleteName'
+    assert not ls.reverseScan(name, aug23), 'List not deleted'
+    ls.append(name, [(jun1, 'x')])
+    ls.purge(name)
+    assert not rconn.keys('liststore::%s::%s*' % (Conf.bucketname, name)), 'Purged lists left in redis'
+    assert not ls.reverseScan(name, aug23), 'List not purged'
+    assert not ls.reverseScan(other, aug23), 'Other list not purged'
+    ls.close()
+
+
+def test_datapage():
+    # a version 1 (json) page is read, and written back as version 3
+    # with its flags in a separate flag page
+    ctab = [{'ctime': 1357000000 + i, 'content': u'hello %d' % i,
+             'seen': i % 2, 'dismissed': int(i % 3 == 0)} for i in xrange(20)]
+    v1 = json.dumps({'magic': 'ListStoreDataPage', 'version': 1, 'ctab': ctab})
+    dp = liststore.ListStoreDataPage(v1)
+    fp = dp.flags
+    assert [dp.row(i, fp) for i in xrange(len(dp))] == ctab, 'v1 page misread'
+
+    v3 = dp.toString()
+    assert len(v3) < len(v1), 'v3 page is not smaller'
+    dp = liststore.ListStoreDataPage(v3)
+    assert dp.flags is None, 'v3 page has inline flags'
+    fp = liststore.ListStoreFlagPage(fp.toString())
+    assert [dp.row(i, fp) for i in xrange(len(dp))] == ctab, 'v3 page misread'
+
+    dp.remove(3)
+    fp.remove(3)
+    dp.truncate(10)
+    fp.resize(10)
+    dp = liststore.ListStoreDataPage(dp.toString())
+    fp = liststore.ListStoreFlagPage(fp.toString())
+    assert [dp.row(i, fp) for i in xrange(len(dp))] == ctab[:3] + ctab[4:11], 'bad remove/truncate'
+
+    # content that is not utf-8 is refused, and the page is unchanged
+    try:
+        dp.append(1357000100, b'\xff\xfe')
+    except liststore.DataError:
+        pass
+    else:
+        assert False, 'Bad content appended'
+    assert [dp.row(i, fp) for i in xrange(len(dp))] == ctab[:3] + ctab[4:11], 'Page changed by a bad append'
@@ -0,0 +1,64 @@
+import threading
+import stats
+
+
+def test_stats():
+    m = stats.Metrics()
+    events = []
+    m.addHook(lambda name, seconds, nbytes, op: events.append((name, nbytes, op)))
+
+    class Store:
+        metrics = m
+        @stats.operation('work')
+        def work(self):
+            m.record('s3.get', 0.002, 100)
+            with m.timer('decode') as t:
+                t.nbytes = 10
+            return 'done'
+
+    with stats.trace() as tr:
+        assert Store().work() == 'done', 'Wrong result of decorated call'
+        # events of another thread working for the call are traced too
+        ctx = stats.context()
+        def other():
+            with stats.restored(ctx):
+                m.record('s3.get', 0.004, 50)
+        th = threading.Thread(target=other)
+        th.start()
+        th.join()
+
+    c = m.snapshot()['counters']
+    assert c['s3.get'] == 2 and c['s3.get.bytes'] == 150, 'Wrong counters %s' % c
+    assert c['work:s3.get'] == 1 and c['work:decode'] == 1, 'Wrong operation counters %s' % c
+    assert c['op.work'] == 1, 'Operation not counted'
+    assert ('decode', 10, 'work') in events, 'Hook not called'
+
+    summary = tr.summary()
+    assert summary['s3.get'] == {'count': 2, 'seconds': 0.006, 'bytes': 150}, 'Wrong trace %s' % summary
+    assert tr.seconds is not None, 'Trace not timed'
+
+    lat = m.snapshot()['latency']['s3.get']
+    assert lat['count'] == 2 and lat['max'] == 0.004, 'Wrong histogram %s' % lat
+    assert 0.002 <= lat['p50'] <= 0.0032 and lat['p99'] >= 0.004, 'Wrong percentiles %s' % lat
+
+    # a call made within another is timed as the outer one only
+    class Outer(Store):
+        @stats.operation('outer')
+        def outer(self):
+            return self.work()
+    Outer().outer()
+    c = m.snapshot()['counters']
+    assert c['op.outer'] == 1 and c['op.work'] == 1, 'Inner call timed %s' % c
+    assert c['outer:s3.get'] == 1, 'Events not counted for the outer call %s' % c
+
+    m.reset()
+    assert m.snapshot() == {'counters': {}, 'latency': {}}, 'Metrics not reset'
+
+    # a failing hook does not fail the event it is called on
+    def fail(name, seconds, nbytes, op):
+        raise ValueError('hook failed')
+    m.addHook(fail)
+    with m.timer('s3.put') as t:
+        t.nbytes = 10
+    assert m.snapshot()['counters']['s3.put'] == 1, 'Event not recorded'
+    m.removeHook(fail)